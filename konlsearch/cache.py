@@ -0,0 +1,102 @@
+from dataclasses import dataclass
+import array
+import collections
+import threading
+import typing
+
+
+_ENTRY_OVERHEAD = 64
+
+
+@dataclass
+class CachedPostings:
+    document_ids: array.array
+    frequencies: array.array
+    max_frequency: int
+
+
+@dataclass
+class CacheStats:
+    hits: int
+    misses: int
+    entries: int
+    size: int
+
+
+class KonlPostingCache:
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._entries: collections.OrderedDict[str, tuple[CachedPostings, int]] = collections.OrderedDict()
+        self._size = 0
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, token: str) -> bool:
+        return token in self._entries
+
+    def get(self, token: str) -> typing.Optional[CachedPostings]:
+        with self._lock:
+            entry = self._entries.get(token)
+
+            if entry is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(token)
+            self._hits += 1
+
+            return entry[0]
+
+    def get_generation(self) -> int:
+        return self._generation
+
+    def put(self, token: str, postings: CachedPostings, generation: int) -> None:
+        size = self.__get_size(token, postings)
+
+        with self._lock:
+            # an invalidation since the read started means the postings may already be stale
+            if generation != self._generation or size > self._max_size:
+                return
+
+            self.__remove(token)
+
+            self._entries[token] = (postings, size)
+            self._size += size
+
+            while self._size > self._max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def invalidate(self, tokens: typing.Iterable[str]) -> None:
+        with self._lock:
+            self._generation += 1
+
+            for token in tokens:
+                self.__remove(token)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._size = 0
+
+    def get_stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(hits=self._hits, misses=self._misses, entries=len(self._entries), size=self._size)
+
+    def __remove(self, token: str) -> None:
+        entry = self._entries.pop(token, None)
+
+        if entry is not None:
+            self._size -= entry[1]
+
+    @staticmethod
+    def __get_size(token: str, postings: CachedPostings) -> int:
+        return (_ENTRY_OVERHEAD + len(token.encode())
+                + postings.document_ids.itemsize * len(postings.document_ids)
+                + postings.frequencies.itemsize * len(postings.frequencies))
@@ -2,8 +2,8 @@ import typing
 
 import rocksdict
 
-from .dict import KonlDefaultDict
-from .set import KonlSet
+from .dict import KonlDefaultDict, KonlDictWriteBatch
+from .set import KonlSet, KonlSetWriteBatch
 
 
 _DIGIT_COUNT = 8
@@ -13,17 +13,19 @@ class KonlCounter:
     def __init__(self, cf: rocksdict.Rdict, prefix: str, max_size: int):
         self._cf = cf
         self._prefix = f'{prefix}:counter'
+        self._len_prefix = f'{prefix}:__len__:counter'
         self._sorted_set = KonlSet(self._cf, self._prefix)
         self._dict = KonlDefaultDict(self._cf, self._prefix, 0)
         self._max_size = max_size
 
     def __len__(self) -> int:
-        len = 0
+        size = self._cf.get(self._len_prefix)
 
-        for _ in self.items():
-            len += 1
+        # counters written before the size key existed are counted once
+        if size is None:
+            size = sum(1 for _ in self._dict.items())
 
-        return len
+        return size
 
     def __contains__(self, key: str) -> bool:
         return key in self._dict
@@ -35,33 +37,30 @@ class KonlCounter:
         self._sorted_set.remove(self.build_set_key(key, self._dict[key]))
         del self._dict[key]
 
+        self.__set_len(len(self) - 1)
+
     def __getitem__(self, key: str):
         return self._dict[key]
 
     def __setitem__(self, key: str, count: int):
-        old_count = self._dict[key]
+        if key in self._dict:
+            self._sorted_set.remove(self.build_set_key(key, self._dict[key]))
+        else:
+            self.__set_len(len(self) + 1)
+
         self._dict[key] = count
         self._sorted_set.add(self.build_set_key(key, count))
 
-        if old_count != 0:
-            self._sorted_set.remove(self.build_set_key(key, old_count))
-
         self.compact()
 
     def destroy(self):
-        for k, _ in self.items():
+        for k, _ in list(self.items()):
             self.__delitem__(k)
 
-    def increase(self, key: str, increment: int = 1):
-        count = self._dict[key]
-        new_count = count + increment
-
-        self._dict[key] = new_count
+        self._cf.delete(self._len_prefix)
 
-        self._sorted_set.add(self.build_set_key(key, new_count))
-        self._sorted_set.remove(self.build_set_key(key, count))
-
-        self.compact()
+    def increase(self, key: str, increment: int = 1):
+        self[key] = self._dict[key] + increment
 
     def decrease(self, key: str, decrement: int = 1):
         count = self._dict[key]
@@ -72,22 +71,45 @@ class KonlCounter:
         new_count = count - decrement
 
         if new_count > 0:
-            self._dict[key] = new_count
-            self._sorted_set.add(self.build_set_key(key, new_count))
-
-        self._sorted_set.remove(self.build_set_key(key, count))
-
-        self.compact()
+            self[key] = new_count
+        else:
+            del self[key]
 
     def compact(self):
-        if len(self._dict) <= self._max_size:
+        size = len(self)
+
+        if size <= self._max_size:
             return
 
-        last_element = list(self._sorted_set.items())[-1]
-        key, value = self.get_from_element(last_element)
+        while size > self._max_size:
+            last_element = self.__get_last_element()
 
-        del self._dict[key]
-        self._sorted_set.remove(last_element)
+            if last_element is None:
+                break
+
+            key, _ = self.get_from_element(last_element)
+
+            del self._dict[key]
+            self._sorted_set.remove(last_element)
+
+            size -= 1
+
+        self.__set_len(size)
+
+    def __get_last_element(self) -> typing.Optional[str]:
+        set_prefix = self._sorted_set.build_key_name("")
+
+        # the sorted set is ordered by descending count, so the minimum is the last key of its range
+        it = self._cf.iter()
+        it.seek_for_prev(set_prefix[:-1] + chr(ord(set_prefix[-1]) + 1))
+
+        if it.valid() and type(it.key()) == str and it.key().startswith(set_prefix):
+            return self._sorted_set.remove_prefix(it.key())
+
+        return None
+
+    def __set_len(self, size: int):
+        self._cf[self._len_prefix] = size
 
     def items(self) -> typing.Generator[tuple[str, int], None, None]:
         for element in self._sorted_set.items():
@@ -103,3 +125,60 @@ class KonlCounter:
     def get_from_element(element: str) -> tuple[str, int]:
         value, key = element.split(":")
         return key, int(value, 16) ^ (16 ** _DIGIT_COUNT - 1)
+
+
+class KonlCounterWriteBatch:
+    def __init__(self, wb: rocksdict.WriteBatch, cf_handle: rocksdict.ColumnFamily, cf: rocksdict.Rdict, prefix: str,
+                 max_size: int):
+        self._wb = wb
+        self._cf_handle = cf_handle
+        self._prefix = f'{prefix}:counter'
+        self._len_prefix = f'{prefix}:__len__:counter'
+        # the inner batches read through the iterator, so they keep their own counts instead of dropping them
+        iter = cf.iter()
+        self._sorted_set_wb = KonlSetWriteBatch(wb, cf_handle, self._prefix, iter)
+        self._dict_wb = KonlDictWriteBatch(wb, cf_handle, self._prefix, iter)
+        self._max_size = max_size
+
+        # a counter holds at most max_size keys, so its whole state is kept in memory for the batch
+        self._counts = dict(KonlDefaultDict(cf, self._prefix, 0).items())
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._counts
+
+    def __getitem__(self, key: str) -> int:
+        return self._counts.get(key, 0)
+
+    def __setitem__(self, key: str, count: int):
+        if key in self._counts:
+            self._sorted_set_wb.remove(KonlCounter.build_set_key(key, self._counts[key]))
+
+        self._counts[key] = count
+        self._dict_wb[key] = count
+        self._sorted_set_wb.add(KonlCounter.build_set_key(key, count))
+
+        while len(self._counts) > self._max_size:
+            last_element = max(KonlCounter.build_set_key(k, c) for k, c in self._counts.items())
+            last_key, _ = KonlCounter.get_from_element(last_element)
+
+            del self._counts[last_key]
+            del self._dict_wb[last_key]
+            self._sorted_set_wb.remove(last_element)
+
+        self._wb.put(self._len_prefix, len(self._counts), self._cf_handle)
+
+    def __delitem__(self, key: str):
+        if key not in self._counts:
+            return
+
+        self._sorted_set_wb.remove(KonlCounter.build_set_key(key, self._counts[key]))
+        del self._counts[key]
+        del self._dict_wb[key]
+
+        self._wb.put(self._len_prefix, len(self._counts), self._cf_handle)
+
+    def increase(self, key: str, increment: int = 1):
+        self[key] = self[key] + increment
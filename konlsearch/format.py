@@ -0,0 +1,173 @@
+import abc
+import enum
+import struct
+import typing
+
+from strenum import StrEnum
+
+from .term import KonlTermDictionary, pack_term_ids, unpack_term_ids
+
+
+_DOCUMENT_TAG = b'd'
+_TOKENS_TAG = b't'
+_LENGTH_TAG = b'l'
+_LENGTH_FORMAT = '>I'
+_DOCUMENT_STORE_SUFFIX = '_documents'
+
+
+def build_document_store_name(index_name: str) -> str:
+    return f'{index_name}{_DOCUMENT_STORE_SUFFIX}'
+
+
+def is_document_store_name(name: str) -> bool:
+    return name.endswith(_DOCUMENT_STORE_SUFFIX)
+
+
+class StorageFormat(StrEnum):
+    V1 = enum.auto()
+    V2 = enum.auto()
+
+
+class KonlDocumentFormat(abc.ABC):
+    storage_format: StorageFormat
+
+    @abc.abstractmethod
+    def build_document_key(self, document_id: int) -> typing.Union[str, bytes]:
+        pass
+
+    @abc.abstractmethod
+    def is_document_key(self, key) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def parse_document_key(self, key) -> int:
+        pass
+
+    @abc.abstractmethod
+    def build_tokens_key(self, document_id: int) -> typing.Union[str, bytes]:
+        pass
+
+    @abc.abstractmethod
+    def build_length_key(self, document_id: int) -> typing.Union[str, bytes]:
+        pass
+
+    @abc.abstractmethod
+    def encode_document(self, document: str):
+        pass
+
+    @abc.abstractmethod
+    def decode_document(self, value) -> str:
+        pass
+
+    @abc.abstractmethod
+    def encode_tokens(self, tokens: typing.Iterable[str]):
+        pass
+
+    @abc.abstractmethod
+    def decode_tokens(self, value) -> typing.Set[str]:
+        pass
+
+    @abc.abstractmethod
+    def encode_length(self, length: int):
+        pass
+
+    @abc.abstractmethod
+    def decode_length(self, value) -> int:
+        pass
+
+    def get_document_prefix(self) -> typing.Union[str, bytes]:
+        return self._prefix
+
+
+class KonlDocumentFormatV1(KonlDocumentFormat):
+    storage_format = StorageFormat.V1
+
+    def __init__(self, name: str, terms: typing.Optional[KonlTermDictionary] = None):
+        self._prefix = f'{name}:document'
+
+    def build_document_key(self, document_id: int) -> str:
+        document_id_s = f'{document_id:x}'.rjust(10, '0')
+        return f'{self._prefix}:{document_id_s}'
+
+    def is_document_key(self, key) -> bool:
+        return isinstance(key, str) and key.startswith(self._prefix)
+
+    def parse_document_key(self, key: str) -> int:
+        return int(key.replace(self._prefix + ":", ""), 16)
+
+    def build_tokens_key(self, document_id: int) -> str:
+        return f'{document_id}:tokens'
+
+    def build_length_key(self, document_id: int) -> str:
+        return f'{document_id}:length'
+
+    def encode_document(self, document: str) -> str:
+        return document
+
+    def decode_document(self, value: str) -> str:
+        return value
+
+    def encode_tokens(self, tokens: typing.Iterable[str]) -> typing.Set[str]:
+        return set(tokens)
+
+    def decode_tokens(self, value: typing.Set[str]) -> typing.Set[str]:
+        return value
+
+    def encode_length(self, length: int) -> int:
+        return length
+
+    def decode_length(self, value: int) -> int:
+        return value
+
+
+class KonlDocumentFormatV2(KonlDocumentFormat):
+    storage_format = StorageFormat.V2
+
+    def __init__(self, name: str, terms: KonlTermDictionary):
+        # the column family already belongs to one index, so keys only carry a tag and a big-endian id
+        self._prefix = _DOCUMENT_TAG
+        self._terms = terms
+
+    def build_document_key(self, document_id: int) -> bytes:
+        return _DOCUMENT_TAG + document_id.to_bytes(8, 'big')
+
+    def is_document_key(self, key) -> bool:
+        return isinstance(key, bytes) and key.startswith(_DOCUMENT_TAG)
+
+    def parse_document_key(self, key: bytes) -> int:
+        return int.from_bytes(key[len(_DOCUMENT_TAG):], 'big')
+
+    def build_tokens_key(self, document_id: int) -> bytes:
+        return _TOKENS_TAG + document_id.to_bytes(8, 'big')
+
+    def build_length_key(self, document_id: int) -> bytes:
+        return _LENGTH_TAG + document_id.to_bytes(8, 'big')
+
+    def encode_document(self, document: str) -> bytes:
+        return document.encode()
+
+    def decode_document(self, value: bytes) -> str:
+        return value.decode()
+
+    def encode_tokens(self, tokens: typing.Iterable[str]) -> bytes:
+        return pack_term_ids(self._terms.get_or_create_ids(tokens).values())
+
+    def decode_tokens(self, value: bytes) -> typing.Set[str]:
+        return set(self._terms.get_tokens(unpack_term_ids(value)).values())
+
+    def encode_length(self, length: int) -> bytes:
+        return struct.pack(_LENGTH_FORMAT, length)
+
+    def decode_length(self, value: bytes) -> int:
+        return struct.unpack(_LENGTH_FORMAT, value)[0]
+
+
+_DOCUMENT_FORMATS = {
+    StorageFormat.V1: KonlDocumentFormatV1,
+    StorageFormat.V2: KonlDocumentFormatV2,
+}
+
+
+def get_document_format(name: str, storage_format: StorageFormat,
+                        terms: typing.Optional[KonlTermDictionary] = None) -> KonlDocumentFormat:
+    return _DOCUMENT_FORMATS[storage_format](name, terms)
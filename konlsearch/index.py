@@ -1,8 +1,15 @@
 from __future__ import annotations
 
 import abc
+import array
+import collections
+import concurrent.futures
 from dataclasses import dataclass
 import enum
+import functools
+import heapq
+import itertools
+import os
 import re
 import typing
 import typing_extensions
@@ -15,10 +22,18 @@ from strenum import StrEnum
 
 import xxhash
 
+from . import posting
+from . import ranking
 from . import utility
-from .inverted_index import KonlInvertedIndex, TokenSearchMode
+from .cache import CacheStats
+from .format import StorageFormat, build_document_store_name, get_document_format
+from .inverted_index import KonlInvertedIndex, KonlInvertedIndexView, TokenSearchMode
+from .log import SearchLogBufferOptions
 from .lock import StripedLock
+from .profile import build_document_options
+from .trie import SUGGESTION_TOP_K, KonlTrie, KonlTrieView, SuggestionOrder
 from .dict import KonlDict, KonlDictView, KonlDictWriteBatch
+from .sst import KonlSstWriteBatch
 
 
 mecab = mecab.MeCab()
@@ -26,6 +41,25 @@ mecab = mecab.MeCab()
 
 _SPECIAL_CHARACTERS = '@_!#$%^&*()<>?/\\|}{~:]",'
 _LAST_DOCUMENT_ID = "last_document_id"
+_INDEX_MANY_BATCH_SIZE = 10000
+_BUILD_BATCH_SIZE = 100000
+_SEARCH_CHUNK_SIZE = 1000
+_MORPHS_CACHE_SIZE = 10000
+_FORMAT_KEY = "storage_format"
+_DOCUMENT_ID_BLOCK_SIZE = 1000
+_LEGACY_POSTING_BATCH_SIZE = 10000
+_WRITE_LOCK_STRIPES = 64
+_DOCUMENT_ID_LOCK = threading.Lock()
+
+
+def morphs(sentence: str) -> typing.Tuple[str, ...]:
+    return tuple(mecab.morphs(sentence))
+
+
+# only queries repeat, so document bodies are analyzed without evicting them
+@functools.lru_cache(maxsize=_MORPHS_CACHE_SIZE)
+def query_morphs(sentence: str) -> typing.Tuple[str, ...]:
+    return morphs(sentence)
 
 
 class SearchMode(StrEnum):
@@ -76,6 +110,12 @@ class ComplexSearchGetRequest:
     mode: SearchMode
 
 
+@dataclass
+class SearchRankedResult:
+    id: int
+    score: float
+
+
 @dataclass
 class IndexingResult:
     status_code: IndexingStatusCode
@@ -90,23 +130,57 @@ class IndexingResult:
         return IndexingResult(status_code=IndexingStatusCode.CONFLICT, document_id=document_id)
 
 
-class KonlIndexWriter(abc.ABC):
-    def build_key_name(self, document_id) -> str:
-        document_id_s = f'{document_id:x}'.rjust(10, '0')
-        return f'{self._prefix}:{document_id_s}'
+class AbstractKonlIndex(abc.ABC):
+    def build_key_name(self, document_id) -> typing.Union[str, bytes]:
+        return self._format.build_document_key(document_id)
 
-    def tokenize(self, document) -> typing.Set[str]:
-        sanitized_document = self.sanitize(document)
+    @staticmethod
+    def tokenize(document) -> typing.Set[str]:
+        return set(AbstractKonlIndex.tokenize_with_frequency(document))
+
+    @staticmethod
+    def tokenize_with_order(document, query: bool = False) -> typing.List[str]:
+        sanitized_document = AbstractKonlIndex.sanitize(document)
+        tokens = query_morphs(sanitized_document) if query else morphs(sanitized_document)
+        return [token for token in tokens if AbstractKonlIndex.is_indexable(token)]
+
+    @staticmethod
+    def tokenize_with_positions(document, query: bool = False) -> typing.Dict[str, typing.List[int]]:
+        positions = {}
+
+        for i, token in enumerate(AbstractKonlIndex.tokenize_with_order(document, query)):
+            positions.setdefault(token, []).append(i)
 
-        return {token for token in
-                set(mecab.morphs(sanitized_document)).union(set(sanitized_document.split())) if self.is_indexable(token)}
+        return positions
+
+    @staticmethod
+    def tokenize_with_frequency(document, positions: typing.Optional[typing.Dict[str, typing.List[int]]] = None,
+                                query: bool = False) -> typing.Dict[str, int]:
+        if positions is None:
+            positions = AbstractKonlIndex.tokenize_with_positions(document, query)
 
-    def generate_hash(self, document) -> str:
+        frequencies = collections.Counter({token: len(token_positions) for token, token_positions in positions.items()})
+        frequencies.update([word for word in AbstractKonlIndex.sanitize(document).split()
+                            if word not in positions and AbstractKonlIndex.is_indexable(word)])
+
+        return dict(frequencies)
+
+    @staticmethod
+    def generate_hash(document) -> str:
         return xxhash.xxh128(document).hexdigest()
 
     @staticmethod
-    def build_token_name(document_id) -> str:
-        return f'{document_id}:tokens'
+    def analyze(document) -> typing.Tuple[str, typing.Dict[str, int], typing.Dict[str, typing.List[int]]]:
+        positions = AbstractKonlIndex.tokenize_with_positions(document)
+        frequencies = AbstractKonlIndex.tokenize_with_frequency(document, positions)
+
+        return AbstractKonlIndex.generate_hash(document), frequencies, positions
+
+    def build_token_name(self, document_id) -> typing.Union[str, bytes]:
+        return self._format.build_tokens_key(document_id)
+
+    def build_length_name(self, document_id) -> typing.Union[str, bytes]:
+        return self._format.build_length_key(document_id)
 
     @staticmethod
     def sanitize(document):
@@ -124,90 +198,326 @@ class KonlIndexWriter(abc.ABC):
 
     @staticmethod
     def is_indexable(token):
-        return KonlIndex.is_alpha(token) or KonlIndex.is_hangul(token)
+        return AbstractKonlIndex.is_alpha(token) or AbstractKonlIndex.is_hangul(token)
+
+
+class KonlIndexReader(AbstractKonlIndex):
+    @abc.abstractmethod
+    def get_value(self, key: typing.Union[str, bytes], default=None):
+        pass
+
+    @abc.abstractmethod
+    def get_documents(self, keys: typing.List[typing.Union[str, bytes]]) -> typing.List[typing.Optional[str]]:
+        pass
+
+    @abc.abstractmethod
+    def get_document_iter(self) -> rocksdict.RdictIter:
+        pass
+
+    @abc.abstractmethod
+    def get_inverted_index_view(self) -> KonlInvertedIndexView:
+        pass
+
+    @abc.abstractmethod
+    def get_trie_view(self) -> typing.Union[KonlTrie, KonlTrieView]:
+        pass
+
+    def __len__(self) -> int:
+        return self.get_value(self._len_prefix, 0)
+
+    def get_total_length(self) -> int:
+        return self.get_value(self._length_prefix, 0)
+
+    def get(self, document_id: int) -> IndexGetResponse:
+        document = self.get_documents([self.build_key_name(document_id)])[0]
+
+        if document is not None:
+            return IndexGetResponse.success(document_id, self._format.decode_document(document))
+        else:
+            return IndexGetResponse.failure()
+
+    def get_multi(self, document_ids: typing.List[int]) -> typing.List[IndexGetResponse]:
+        keys = [self.build_key_name(document_id) for document_id in document_ids]
+
+        return [IndexGetResponse.success(document_ids[i], self._format.decode_document(document))
+                for i, document in enumerate(self.get_documents(keys)) if document]
+
+    def get_all(self, limit: typing.Optional[int] = None,
+                after_id: typing.Optional[int] = None) -> typing.List[IndexGetResponse]:
+        return list(itertools.islice(self.iter_all(after_id), limit))
+
+    def iter_all(self, after_id: typing.Optional[int] = None) -> typing.Generator[IndexGetResponse, None, None]:
+        if after_id is None:
+            yield from self.__iter_documents(self._format.get_document_prefix())
+        else:
+            yield from self.__iter_documents(self.build_key_name(after_id + 1))
+
+    def get_range(self, start_id: int, end_id: int, limit: typing.Optional[int] = None) -> typing.List[IndexGetResponse]:
+        return list(itertools.islice(self.iter_range(start_id, end_id), limit))
+
+    def iter_range(self, start_id: int, end_id: int) -> typing.Generator[IndexGetResponse, None, None]:
+        if end_id <= start_id:
+            return
+
+        yield from self.__iter_documents(self.build_key_name(start_id), self.build_key_name(end_id))
+
+    def __iter_documents(self, start_key: typing.Union[str, bytes], end_key: typing.Union[str, bytes, None] = None) \
+            -> typing.Generator[IndexGetResponse, None, None]:
+        it = self.get_document_iter()
+        it.seek(start_key)
+
+        while it.valid() and self._format.is_document_key(it.key()) and (end_key is None or it.key() < end_key):
+            key = it.key()
+
+            yield IndexGetResponse.success(self._format.parse_document_key(key), self._format.decode_document(it.value()))
+
+            # a snapshot shares the iterator with get(), so it is moved back when a caller read a document in between
+            if not (it.valid() and it.key() == key):
+                it.seek(key)
+
+            it.next()
+
+    def get_tokens(self, document_id) -> typing.Set[str]:
+        value = self.get_value(self.build_token_name(document_id))
+
+        if value is None:
+            raise KeyError
+
+        return self._format.decode_tokens(value)
+
+    def get_length(self, document_id) -> int:
+        length = self.get_value(self.build_length_name(document_id))
+
+        return 0 if length is None else self._format.decode_length(length)
+
+    def search_ranked(self, tokens: typing.List[str], k: int = 10) -> typing.List[SearchRankedResult]:
+        document_count = len(self)
+
+        if document_count == 0:
+            return []
+
+        average_length = self.get_total_length() / document_count or 1
+        postings = self.get_inverted_index_view().get_term_postings(tokens)
+
+        return [SearchRankedResult(id=document_id, score=score) for score, document_id
+                in ranking.top_k(postings, k, document_count, average_length, self.get_length)]
+
+    def search_complex(self, request: ComplexSearchGetRequest, limit: typing.Optional[int] = None,
+                       after_id: typing.Optional[int] = None) -> typing.List[int]:
+        if limit is not None or after_id is not None:
+            return list(itertools.islice(self.iter_search_complex(request, after_id), limit))
+
+        return self.__search_complex(request, True).tolist()
+
+    def iter_search_complex(self, request: ComplexSearchGetRequest, after_id: typing.Optional[int] = None) \
+            -> typing.Generator[int, None, None]:
+        result1 = self.__iter_search_condition(request.condition1, after_id)
+        result2 = self.__iter_search_condition(request.condition2, after_id)
+
+        if request.mode == SearchMode.AND:
+            yield from utility.intersect_sorted(result1, result2)
+        elif request.mode == SearchMode.OR:
+            yield from utility.unique_sorted(heapq.merge(result1, result2))
+
+    def __iter_search_condition(self, condition: typing.Union[SearchGetRequest, ComplexSearchGetRequest],
+                                after_id: typing.Optional[int]) -> typing.Generator[int, None, None]:
+        if isinstance(condition, ComplexSearchGetRequest):
+            return self.iter_search_complex(condition, after_id)
+        else:
+            return self.iter_search(condition.tokens, condition.mode, after_id)
+
+    def count(self, tokens: typing.List[str], mode: TokenSearchMode) -> int:
+        # counting is not a search, so the phrase candidates are read without logging their tokens
+        if mode == TokenSearchMode.PHRASE:
+            return sum(1 for _ in self.__iter_search(tokens, mode, None, False))
+
+        return self.get_inverted_index_view().count(tokens, mode)
+
+    def count_complex(self, request: ComplexSearchGetRequest) -> int:
+        result1 = self.__search_condition(request.condition1, False)
+        result2 = self.__search_condition(request.condition2, False)
+
+        if request.mode == SearchMode.AND:
+            return len(posting.intersect(result1, result2))
+        elif request.mode == SearchMode.OR:
+            return posting.count_union([result1, result2])
+        else:
+            return 0
+
+    def __search_complex(self, request: ComplexSearchGetRequest, log: bool) -> array.array:
+        result1 = self.__search_condition(request.condition1, log)
+        result2 = self.__search_condition(request.condition2, log)
+
+        if request.mode == SearchMode.AND:
+            return posting.intersect(result1, result2)
+        elif request.mode == SearchMode.OR:
+            return posting.union([result1, result2])
+        else:
+            return posting.new_array()
+
+    def __search_condition(self, condition: typing.Union[SearchGetRequest, ComplexSearchGetRequest],
+                           log: bool) -> array.array:
+        if isinstance(condition, ComplexSearchGetRequest):
+            return self.__search_complex(condition, log)
+        elif condition.mode == TokenSearchMode.PHRASE and log:
+            return posting.new_array(self.search(condition.tokens, condition.mode))
+        elif condition.mode == TokenSearchMode.PHRASE:
+            return posting.new_array(self.__iter_search(condition.tokens, condition.mode, None, False))
+        else:
+            return self.get_inverted_index_view().search_array(condition.tokens, condition.mode, log)
+
+    def search_text(self, query: str, mode: TokenSearchMode, limit: typing.Optional[int] = None,
+                    after_id: typing.Optional[int] = None) -> typing.List[int]:
+        if mode == TokenSearchMode.PHRASE:
+            tokens = self.tokenize_with_order(query, True)
+        else:
+            tokens = list(self.tokenize_with_frequency(query, query=True))
+
+        return self.search(tokens, mode, limit, after_id)
+
+    def search(self, tokens: typing.List[str], mode: TokenSearchMode, limit: typing.Optional[int] = None,
+               after_id: typing.Optional[int] = None) -> typing.List[int]:
+        if limit is not None or after_id is not None:
+            return list(itertools.islice(self.iter_search(tokens, mode, after_id), limit))
+
+        inverted_index = self.get_inverted_index_view()
+
+        if mode != TokenSearchMode.PHRASE:
+            return inverted_index.search(tokens, mode)
+
+        result = inverted_index.search_array(tokens, TokenSearchMode.AND)
+
+        return self.__filter_phrase(inverted_index, self.tokenize_with_order(" ".join(tokens), True), result)
+
+    def iter_search(self, tokens: typing.List[str], mode: TokenSearchMode, after_id: typing.Optional[int] = None) \
+            -> typing.Generator[int, None, None]:
+        return self.__iter_search(tokens, mode, after_id, True)
+
+    def __iter_search(self, tokens: typing.List[str], mode: TokenSearchMode, after_id: typing.Optional[int],
+                      log: bool) -> typing.Generator[int, None, None]:
+        inverted_index = self.get_inverted_index_view()
+
+        if mode != TokenSearchMode.PHRASE:
+            yield from inverted_index.iter_search(tokens, mode, after_id, log)
+            return
+
+        sanitized_tokens = self.tokenize_with_order(" ".join(tokens), True)
+
+        for candidates in utility.batched(inverted_index.iter_search(tokens, TokenSearchMode.AND, after_id, log),
+                                          _SEARCH_CHUNK_SIZE):
+            yield from self.__filter_phrase(inverted_index, sanitized_tokens, candidates)
+
+    @staticmethod
+    def __filter_phrase(inverted_index: KonlInvertedIndexView, sanitized_tokens: typing.List[str],
+                        document_ids: typing.Sequence[int]) -> typing.List[int]:
+        positions = inverted_index.get_positions(sanitized_tokens, document_ids)
+
+        return [document_id for document_id in document_ids
+                if all(positions[token].get(document_id) for token in sanitized_tokens)
+                and utility.is_sorted([positions[token][document_id][0] for token in sanitized_tokens])]
+
+    def search_near(self, tokens: typing.List[str], distance: int) -> typing.List[int]:
+        inverted_index = self.get_inverted_index_view()
+        result = inverted_index.search_array(tokens, TokenSearchMode.AND)
+
+        sanitized_tokens = list(dict.fromkeys(self.tokenize_with_order(" ".join(tokens), True)))
+        positions = inverted_index.get_positions(sanitized_tokens, result)
+
+        return [document_id for document_id in result
+                if all(positions[token].get(document_id) for token in sanitized_tokens)
+                and utility.min_span([positions[token][document_id] for token in sanitized_tokens]) <= distance]
+
+    def search_suggestions(self, prefix: str) -> typing.List[str]:
+        return self.get_trie_view().search(prefix)
+
+
+class KonlIndexWriter(AbstractKonlIndex):
+    @abc.abstractmethod
+    def index(self, document) -> IndexingResult:
+        pass
+
+    @abc.abstractmethod
+    def delete(self, document_id) -> None:
+        pass
 
 
 class KonlIndexWriteBatch(KonlIndexWriter):
-    def __init__(self, index: KonlIndex):
+    def __init__(self, index: KonlIndex, wb: typing.Union[rocksdict.WriteBatch, KonlSstWriteBatch, None] = None,
+                 deferred_trie: bool = False):
+        self._index = index
         self._cf = index._cf
         self._iter = self._cf.iter()
-        self._wb = rocksdict.WriteBatch()
+        self._wb = rocksdict.WriteBatch() if wb is None else wb
         self._name = index._name
-        self._cf_handle = self._cf.get_column_family_handle(self._name)
-        self._inverted_index_wb = index._inverted_index.to_write_batch(self._wb)
-        self._prefix = index._prefix
+        self._cf_handle = index._cf_handle
+        self._document_iter = index._document_cf.iter()
+        self._document_cf_handle = index._document_cf_handle
+        self._inverted_index = index._inverted_index
+        self._deferred_trie = deferred_trie
+        self._inverted_index_wb = index._inverted_index.to_write_batch(self._wb, deferred_trie)
+        self._format = index._format
         self._len_prefix = index._len_prefix
+        self._length_prefix = index._length_prefix
         self._hash_prefix = index._hash_prefix
-        self._last_document_id = self.__get_last_document_id()
         self._indexing_count = 0
-        self._indexed_documents = {}
+        self._length_delta = 0
+        self._hash_updates: typing.Dict[str, typing.Optional[int]] = {}
         self._deleting_count = 0
         self._deleted_document_ids = set()
 
     def __len__(self):
-        it = self._iter
-        it.seek(self._len_prefix)
+        # shared counters are read from the column family rather than the snapshot, since other writers move them
+        return self._cf.get(self._len_prefix, 0) + self._indexing_count - self._deleting_count
 
-        if it.valid() and it.key() == self._len_prefix:
-            len = it.value()
-        else:
-            len = 0
-
-        return len + self._indexing_count - self._deleting_count
+    def get_total_length(self) -> int:
+        return self._cf.get(self._length_prefix, 0) + self._length_delta
 
     def get_document_id_from_hash(self, hash: str) -> typing.Optional[int]:
+        if hash in self._hash_updates:
+            return self._hash_updates[hash]
+
         d = KonlDictView(self._iter, self._hash_prefix)
 
         try:
-            return self._indexed_documents[hash] or d[hash]
+            return d[hash]
         except KeyError:
             return None
 
     def add_document_hash(self, document_id: int, hash: str):
-        d = KonlDictWriteBatch(self._wb, self._cf_handle, self._hash_prefix)
-
-        d[hash] = document_id
-        self._indexed_documents[hash] = document_id
+        self._hash_updates[hash] = document_id
 
     def delete_document_hash(self, hash: str):
-        d = KonlDictWriteBatch(self._wb, self._cf_handle, self._hash_prefix)
-
-        del d[hash]
+        self._hash_updates[hash] = None
 
-    def __get_last_document_id(self):
-        it = self._iter
-
-        last_document_id = 1
-
-        it.seek(_LAST_DOCUMENT_ID)
-
-        if it.valid() and it.key() == _LAST_DOCUMENT_ID:
-            last_document_id = it.value()
+    def index(self, document) -> IndexingResult:
+        document_hash, frequencies, positions = self.analyze(document)
 
-        return last_document_id
+        return self.index_analyzed(document, document_hash, frequencies, positions)
 
-    def index(self, document) -> IndexingResult:
-        document_hash = self.generate_hash(document)
+    def index_analyzed(self, document, document_hash: str, frequencies: typing.Dict[str, int],
+                       positions: typing.Optional[typing.Dict[str, typing.List[int]]] = None) -> IndexingResult:
         conflicting_document_id = self.get_document_id_from_hash(document_hash)
 
         if conflicting_document_id:
             return IndexingResult.conflict(conflicting_document_id)
 
-        tokens = self.tokenize(document)
+        document_id = self._index.allocate_document_id()
 
-        self._last_document_id += 1
+        key = self.build_key_name(document_id)
+        length = sum(frequencies.values())
 
-        key = self.build_key_name(self._last_document_id)
+        self._wb.put(key, self._format.encode_document(document), self._document_cf_handle)
+        self._wb.put(self.build_token_name(document_id), self._format.encode_tokens(frequencies), self._cf_handle)
+        self._wb.put(self.build_length_name(document_id), self._format.encode_length(length), self._cf_handle)
 
-        self._wb.put(key, document, self._cf_handle)
-        self._wb.put(self.build_token_name(self._last_document_id), tokens, self._cf_handle)
+        self._inverted_index_wb.index(document_id, frequencies, positions)
 
-        self._inverted_index_wb.index(self._last_document_id, tokens)
+        self._length_delta += length
 
         self._indexing_count += 1
-        self.add_document_hash(self._last_document_id, document_hash)
+        self.add_document_hash(document_id, document_hash)
 
-        return IndexingResult.success(self._last_document_id)
+        return IndexingResult.success(document_id)
 
     def delete(self, document_id) -> None:
         if document_id in self._deleted_document_ids:
@@ -223,16 +533,20 @@ class KonlIndexWriteBatch(KonlIndexWriter):
 
         token_name = self.build_token_name(document_id)
 
-        it = self._iter
-        it.seek(token_name)
+        tokens = utility.get_value(self._iter, token_name)
 
-        if it.valid() and it.key() == token_name:
-            self._inverted_index_wb.delete(document_id, it.value())
+        if tokens is not None:
+            self._inverted_index_wb.delete(document_id, self._format.decode_tokens(tokens))
 
         self._wb.delete(token_name, self._cf_handle)
 
+        length_name = self.build_length_name(document_id)
+        length = utility.get_value(self._iter, length_name)
+        self._length_delta -= 0 if length is None else self._format.decode_length(length)
+        self._wb.delete(length_name, self._cf_handle)
+
         document_id_key = self.build_key_name(document_id)
-        self._wb.delete(document_id_key, self._cf_handle)
+        self._wb.delete(document_id_key, self._document_cf_handle)
 
         self._deleting_count += 1
         self._deleted_document_ids.add(document_id)
@@ -241,45 +555,162 @@ class KonlIndexWriteBatch(KonlIndexWriter):
         if document_id in self._deleted_document_ids:
             return IndexGetResponse.failure()
 
-        document_id_key = self.build_key_name(document_id)
-        it = self._iter
-        it.seek(document_id_key)
+        document = utility.get_value(self._document_iter, self.build_key_name(document_id))
 
-        if it.valid() and it.key() == document_id_key:
-            return IndexGetResponse.success(document_id, it.value())
+        if document is not None:
+            return IndexGetResponse.success(document_id, self._format.decode_document(document))
         else:
             return IndexGetResponse.failure()
 
-    def commit(self):
-        self._wb.put(_LAST_DOCUMENT_ID, self._last_document_id, self._cf_handle)
+    def write_metadata(self):
+        hash_dict_wb = KonlDictWriteBatch(self._wb, self._cf_handle, self._hash_prefix, self._cf.iter())
+
+        for hash, document_id in self._hash_updates.items():
+            if document_id is None:
+                del hash_dict_wb[hash]
+            else:
+                hash_dict_wb[hash] = document_id
+
         self._wb.put(self._len_prefix, len(self), self._cf_handle)
+        self._wb.put(self._length_prefix, max(self.get_total_length(), 0), self._cf_handle)
 
-        self._cf.write(self._wb)
+    def finalize(self):
+        self._inverted_index_wb.finalize()
+        self.write_metadata()
+
+    def commit(self):
+        # everything shared between writers is read and written under the commit lock, which only covers the write
+        with self._index._commit_lock:
+            self.finalize()
+            self._cf.write(self._wb)
+
+        self._inverted_index.invalidate_cache(self._wb)
 
         self.clear()
 
     def rollback(self):
         self._wb.clear()
+        self._inverted_index.discard_pending_tokens(self._wb)
+        self._inverted_index_wb = self._inverted_index.to_write_batch(self._wb, self._deferred_trie)
+        self._deleted_document_ids = set()
         self.clear()
 
     def clear(self):
-        self._indexed_documents = {}
+        self._hash_updates = {}
         self._indexing_count = 0
+        self._deleting_count = 0
+        self._length_delta = 0
 
 
-class KonlIndex(KonlIndexWriter):
-    def __init__(self, db: rocksdict.Rdict, name: str):
+class KonlIndexSnapshot(KonlIndexReader):
+    def __init__(self, index: KonlIndex):
+        self._name = index._name
+        self._format = index._format
+        self._len_prefix = index._len_prefix
+        self._length_prefix = index._length_prefix
+        # rocksdb iterators are consistent views of the moment they are created, so every read goes through these
+        self._iter = index._cf.iter()
+        self._document_iter = index._document_cf.iter()
+        self._inverted_index = index._inverted_index.to_view(index._inverted_index._cf.iter())
+        self._trie = index._inverted_index._trie.to_view()
+
+    def get_value(self, key: typing.Union[str, bytes], default=None):
+        return utility.get_value(self._iter, key, default)
+
+    def get_documents(self, keys: typing.List[typing.Union[str, bytes]]) -> typing.List[typing.Optional[str]]:
+        return [utility.get_value(self._document_iter, key) for key in keys]
+
+    def get_document_iter(self) -> rocksdict.RdictIter:
+        return self._document_iter
+
+    def get_inverted_index_view(self) -> KonlInvertedIndexView:
+        return self._inverted_index
+
+    def get_trie_view(self) -> KonlTrieView:
+        return self._trie
+
+    def close(self):
+        self._iter = None
+        self._document_iter = None
+        self._inverted_index = None
+        self._trie = None
+
+
+class KonlIndex(KonlIndexReader, KonlIndexWriter):
+    def __init__(self, db: rocksdict.Rdict, name: str, log_buffer_options: typing.Optional[SearchLogBufferOptions] = None,
+                 options: typing.Optional[rocksdict.Options] = None,
+                 storage_format: typing.Optional[StorageFormat] = None,
+                 document_options: typing.Optional[rocksdict.Options] = None,
+                 suggestion_top_k: int = SUGGESTION_TOP_K):
         self._db = db
         self._name = name
-        self._cf = utility.create_or_get_cf(db, name)
-        self._inverted_index = KonlInvertedIndex(db, name)
-        self._locks = StripedLock(threading.Lock, 10)
-        self._prefix = f'{name}:document'
+        self._cf = utility.create_or_get_cf(db, name, options)
+        self._cf_handle = db.get_column_family_handle(name)
+        self._options = rocksdict.Options() if options is None else options
+        storage_format = self.__load_storage_format(storage_format)
+        self._locks = StripedLock(threading.Lock, _WRITE_LOCK_STRIPES)
+        self._commit_lock = threading.Lock()
+        self._inverted_index = KonlInvertedIndex(db, name, log_buffer_options=log_buffer_options, options=options,
+                                                 storage_format=storage_format, suggestion_top_k=suggestion_top_k,
+                                                 commit_lock=self._commit_lock)
+        self._document_id_lock = threading.Lock()
+        self._next_document_id = 0
+        self._document_id_limit = 0
         self._len_prefix = f'{name}:__len__:document'
+        self._length_prefix = f'{name}:__length__:document'
         self._hash_prefix = f'{name}:hash'
+        self._format = get_document_format(name, storage_format, self._inverted_index.get_term_dictionary())
+        self._document_options = build_document_options() if document_options is None else document_options
+        self._document_cf, self._document_cf_handle = self.open_document_store(storage_format)
+
+        # indexes written before the block postings have no format marker and keep {token}:set:{id} keys,
+        # which are converted once here, so they never answer searches from half of their postings
+        if _FORMAT_KEY not in self._cf and storage_format == StorageFormat.V1:
+            self.convert_legacy_postings()
+
+            if _LAST_DOCUMENT_ID in self._cf:
+                self._cf[_FORMAT_KEY] = str(storage_format)
+
+    def open_document_store(self, storage_format: StorageFormat) -> tuple[rocksdict.Rdict, rocksdict.ColumnFamily]:
+        if storage_format == StorageFormat.V1:
+            return self._cf, self._cf_handle
+
+        # v2 documents live in their own column family, so compactions of the small keys never rewrite them
+        name = build_document_store_name(self._name)
+        cf = utility.create_or_get_cf(self._db, name, self._document_options)
+
+        return cf, self._db.get_column_family_handle(name)
+
+    def get_storage_format(self) -> StorageFormat:
+        return self._format.storage_format
+
+    def set_storage_format(self, storage_format: StorageFormat):
+        self._cf[_FORMAT_KEY] = str(storage_format)
+        self._format = get_document_format(self._name, storage_format, self._inverted_index.get_term_dictionary())
+        self._inverted_index.set_storage_format(storage_format)
+        self.__close_document_store()
+        self._document_cf, self._document_cf_handle = self.open_document_store(storage_format)
+
+    def __load_storage_format(self, storage_format: typing.Optional[StorageFormat]) -> StorageFormat:
+        stored_format = self._cf.get(_FORMAT_KEY)
+
+        if stored_format is not None:
+            stored_format = StorageFormat(stored_format)
+        elif _LAST_DOCUMENT_ID in self._cf:
+            stored_format = StorageFormat.V1
+        elif storage_format is not None:
+            self._cf[_FORMAT_KEY] = str(storage_format)
+            return storage_format
+        else:
+            return StorageFormat.V1
+
+        if storage_format is not None and storage_format != stored_format:
+            raise ValueError(f'index {self._name} is stored in {stored_format}, migrate it to use {storage_format}')
+
+        return stored_format
 
     def get_document_id_from_hash(self, hash: str) -> typing.Optional[int]:
-        d = KonlDict(self._cf, self._hash_prefix)
+        d = KonlDict(self._cf, self._hash_prefix, self._cf_handle)
 
         try:
             return d[hash]
@@ -287,184 +718,291 @@ class KonlIndex(KonlIndexWriter):
             return None
 
     def add_document_hash(self, document_id: int, hash: str):
-        d = KonlDict(self._cf, self._hash_prefix)
+        d = KonlDict(self._cf, self._hash_prefix, self._cf_handle)
 
         d[hash] = document_id
 
     def delete_document_hash(self, hash: str):
-        d = KonlDict(self._cf, self._hash_prefix)
+        d = KonlDict(self._cf, self._hash_prefix, self._cf_handle)
 
         del d[hash]
 
-    def index(self, document) -> IndexingResult:
-        with self._locks.get(self._name):
-            document_hash = self.generate_hash(document)
-            conflicting_document_id = self.get_document_id_from_hash(document_hash)
+    def convert_legacy_postings(self, batch_size: int = _LEGACY_POSTING_BATCH_SIZE) -> int:
+        inverted_index = self._inverted_index
 
-            if conflicting_document_id:
-                return IndexingResult.conflict(conflicting_document_id)
+        if next(self.__iter_legacy_posting_keys(), None) is None:
+            return 0
 
-            tokens = self.tokenize(document)
+        with self._locks.acquire_all():
+            count = 0
 
-            last_document_id = 1
+            # the sets never stored frequencies or positions, so the postings are rebuilt from their documents
+            for batch in utility.batched(self.iter_all(), batch_size):
+                document_tokens = [(r.result.id, self._cf.get(self.build_token_name(r.result.id))) for r in batch]
+                pairs = [(document_id, token) for document_id, tokens in document_tokens if tokens is not None
+                         for token in self._format.decode_tokens(tokens)]
+                values = inverted_index._cf[[self.__build_legacy_posting_key(token, document_id)
+                                             for document_id, token in pairs]] if pairs else []
+                legacy_tokens = {}
 
-            if _LAST_DOCUMENT_ID in self._cf:
-                last_document_id = self._cf[_LAST_DOCUMENT_ID] + 1
+                for (document_id, token), value in zip(pairs, values):
+                    if value is not None:
+                        legacy_tokens.setdefault(document_id, set()).add(token)
 
-            self._cf[_LAST_DOCUMENT_ID] = last_document_id
+                if not legacy_tokens:
+                    continue
 
-            key = self.build_key_name(last_document_id)
+                wb = rocksdict.WriteBatch()
+                inverted_index_wb = inverted_index.to_write_batch(wb)
 
-            self._cf[key] = document
-            self._cf[self.build_token_name(last_document_id)] = tokens
-            size = self.__len__()
-            self.__set_len(size+1)
+                for response in batch:
+                    tokens = legacy_tokens.get(response.result.id)
 
-            self._inverted_index.index(last_document_id, tokens)
+                    if tokens:
+                        _, frequencies, positions = self.analyze(response.result.document)
+                        inverted_index_wb.index(response.result.id,
+                                                {token: frequencies.get(token, 1) for token in tokens}, positions)
 
-            self.add_document_hash(last_document_id, document_hash)
+                with self._commit_lock:
+                    inverted_index._cf.write(wb)
 
-        return IndexingResult.success(last_document_id)
+                inverted_index.invalidate_cache(wb)
+                count += len(legacy_tokens)
 
-    def to_write_batch(self):
-        return KonlIndexWriteBatch(self)
+            for batch in utility.batched(self.__iter_legacy_posting_keys(), batch_size):
+                wb = rocksdict.WriteBatch()
 
-    def delete(self, document_id) -> None:
-        with self._locks.get(self._name):
-            document_id_key = self.build_key_name(document_id)
+                for key in batch:
+                    wb.delete(key, inverted_index._cf_handle)
 
-            if document_id_key not in self._cf:
-                raise KeyError
+                inverted_index._cf.write(wb)
 
-            get_response = self.get(document_id)
+            return count
 
-            document_hash = self.generate_hash(get_response.result.document)
-            self.delete_document_hash(document_hash)
+    @staticmethod
+    def __build_legacy_posting_key(token: str, document_id: int) -> str:
+        return f'{token}:set:{document_id}'
 
-            token_name = self.build_token_name(document_id)
-            tokens = self._cf[token_name]
+    def __iter_legacy_posting_keys(self) -> typing.Generator[str, None, None]:
+        it = self._inverted_index._cf.iter()
+        it.seek_to_first()
 
-            self._inverted_index.delete(document_id, tokens)
+        # {token}:set:{id} and {token}:__len__:set, including those left behind by documents deleted since
+        while it.valid():
+            key = it.key()
 
-            self._cf.delete(token_name)
+            if isinstance(key, str):
+                parts = key.split(":")
 
-            document_id_key = self.build_key_name(document_id)
-            self._cf.delete(document_id_key)
+                if len(parts) == 3 and ((parts[1] == "set" and parts[2].isdigit()) or parts[1:] == ["__len__", "set"]):
+                    yield key
+
+            it.next()
 
-            size = self.__len__()
-            if size > 0:
-                self.__set_len(size-1)
+    def allocate_document_id(self) -> int:
+        with self._document_id_lock:
+            if self._next_document_id >= self._document_id_limit:
+                self.__reserve_document_ids()
 
-    def commit(self, wb: rocksdict.WriteBatch):
-        self._cf.write(wb)
+            self._next_document_id += 1
 
-    def rollback(self, wb: rocksdict.WriteBatch):
-        wb.clear()
+            return self._next_document_id
 
-    def get(self, document_id) -> IndexGetResponse:
-        document_id_key = self.build_key_name(document_id)
+    def __reserve_document_ids(self):
+        # ids are reserved a block at a time, so concurrent batches never share a counter;
+        # the unused rest of a block is skipped after a restart
+        with _DOCUMENT_ID_LOCK:
+            self._next_document_id = self._cf.get(_LAST_DOCUMENT_ID, 0)
+            self._document_id_limit = self._next_document_id + _DOCUMENT_ID_BLOCK_SIZE
+            self._cf[_LAST_DOCUMENT_ID] = self._document_id_limit
 
-        if document_id_key in self._cf:
-            return IndexGetResponse.success(document_id, self._cf[document_id_key])
-        else:
-            return IndexGetResponse.failure()
+    def index(self, document) -> IndexingResult:
+        document_hash = self.generate_hash(document)
+        conflicting_document_id = self.get_document_id_from_hash(document_hash)
 
-    def get_all(self) -> typing.List[IndexGetResponse]:
-        it = self._cf.iter()
-        it.seek(self._prefix)
+        if conflicting_document_id:
+            return IndexingResult.conflict(conflicting_document_id)
 
-        result = []
+        positions = self.tokenize_with_positions(document)
+        frequencies = self.tokenize_with_frequency(document, positions)
 
-        while it.valid() and type(it.key()) == str and it.key().startswith(self._prefix):
-            r = IndexGetResponse.success(int(self.__remove_prefix(it.key())), it.value())
-            result.append(r)
-            it.next()
+        # writers only wait for each other when they share the document hash or a token
+        with self._locks.acquire([document_hash, *frequencies]):
+            index_wb = self.to_write_batch(deferred_trie=True)
+
+            # the document, its metadata, postings and trie entries are written as one atomic batch
+            result = index_wb.index_analyzed(document, document_hash, frequencies, positions)
+
+            if result.status_code == IndexingStatusCode.SUCCESS:
+                index_wb.commit()
 
         return result
 
-    def get_range(self, start_id: int, end_id: int) -> typing.List[IndexGetResponse]:
-        if end_id <= start_id:
-            return []
+    def index_many(self, documents: typing.Iterable[str], workers: typing.Optional[int] = None,
+                   batch_size: int = _INDEX_MANY_BATCH_SIZE) -> typing.List[IndexingResult]:
+        result = []
 
-        it = self._cf.iter()
+        for batch, analyzed in self.__analyze_many(documents, workers or os.cpu_count() or 1, batch_size):
+            with self._locks.acquire_all():
+                index_wb = self.to_write_batch(deferred_trie=True)
 
-        start_key = self.build_key_name(start_id)
-        end_key = self.build_key_name(end_id)
+                for document, (document_hash, frequencies, positions) in zip(batch, analyzed):
+                    result.append(index_wb.index_analyzed(document, document_hash, frequencies, positions))
 
-        it.seek(start_key)
+                index_wb.commit()
+
+        return result
 
+    def build(self, documents: typing.Iterable[str], workers: typing.Optional[int] = None,
+              batch_size: int = _BUILD_BATCH_SIZE, path: typing.Optional[str] = None) -> typing.List[IndexingResult]:
         result = []
 
-        while it.valid() and type(it.key()) == str and it.key().startswith(self._prefix) and it.key() < end_key:
-            r = IndexGetResponse.success(int(self.__remove_prefix(it.key())), it.value())
-            result.append(r)
-            it.next()
+        inverted_index = self._inverted_index
+        trie = inverted_index._trie
+
+        with self._locks.acquire_all():
+            sst_wb = KonlSstWriteBatch({self._cf_handle: self._cf,
+                                        self._document_cf_handle: self._document_cf,
+                                        inverted_index._cf_handle: inverted_index._cf,
+                                        trie._cf_handle: trie._cf}, path,
+                                       {self._document_cf_handle: self._document_options,
+                                        self._cf_handle: self._options,
+                                        inverted_index._cf_handle: self._options,
+                                        trie._cf_handle: self._options})
+
+            # each batch is ingested before the next one starts, so its overlays never outlive the batch
+            for batch, analyzed in self.__analyze_many(documents, workers or os.cpu_count() or 1, batch_size):
+                index_wb = KonlIndexWriteBatch(self, sst_wb, deferred_trie=True)
+
+                for document, (document_hash, frequencies, positions) in zip(batch, analyzed):
+                    result.append(index_wb.index_analyzed(document, document_hash, frequencies, positions))
+
+                with self._commit_lock:
+                    index_wb.finalize()
+                    sst_wb.ingest()
+
+                inverted_index.invalidate_cache(sst_wb)
 
         return result
 
-    def get_multi(self, document_ids: typing.List[int]) -> typing.List[IndexGetResponse]:
-        keys = [self.build_key_name(document_id) for document_id in document_ids]
+    @staticmethod
+    def __analyze_many(documents: typing.Iterable[str], workers: int, batch_size: int) \
+            -> typing.Generator[tuple[typing.List[str], typing.List[tuple]], None, None]:
+        if workers <= 1:
+            for batch in utility.batched(documents, batch_size):
+                yield batch, [AbstractKonlIndex.analyze(document) for document in batch]
 
-        return [IndexGetResponse.success(document_ids[i], document) for i, document in enumerate(self._cf[keys]) if document]
+            return
 
-    def get_tokens(self, document_id) -> typing.Set[str]:
-        return self._cf[self.build_token_name(document_id)]
+        chunksize = max(1, batch_size // (workers * 4))
 
-    def search_complex(self, request: ComplexSearchGetRequest) -> typing.List[int]:
-        if isinstance(request.condition1, ComplexSearchGetRequest):
-            result1 = self.search_complex(request.condition1)
-        else:
-            result1 = self.search(request.condition1.tokens, request.condition1.mode)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = None
 
-        if isinstance(request.condition2, ComplexSearchGetRequest):
-            result2 = self.search_complex(request.condition2)
-        else:
-            result2 = self.search(request.condition2.tokens, request.condition2.mode)
+            # the next batch is submitted to the pool before the current one is written
+            for batch in utility.batched(documents, batch_size):
+                submitted = batch, executor.map(AbstractKonlIndex.analyze, batch, chunksize=chunksize)
 
-        if request.mode == SearchMode.AND:
-            return sorted(set(result1).intersection(set(result2)))
-        elif request.mode == SearchMode.OR:
-            return sorted(set(result1).union(set(result2)))
-        else:
-            return []
+                if pending:
+                    yield pending[0], list(pending[1])
 
-    # noinspection PyBroadException
-    def search(self, tokens: typing.List[str], mode: TokenSearchMode) -> typing.List[int]:
-        if mode != TokenSearchMode.PHRASE:
-            return self._inverted_index.search(tokens, mode)
+                pending = submitted
 
-        result = self._inverted_index.search(tokens, TokenSearchMode.AND)
+            if pending:
+                yield pending[0], list(pending[1])
 
-        sanitized_tokens = self.__tokenize_with_order(" ".join(tokens))
+    def to_write_batch(self, deferred_trie: bool = False):
+        return KonlIndexWriteBatch(self, deferred_trie=deferred_trie)
 
-        tokens_with_ids = [(response.result.id, self.__tokenize_with_order(response.result.document))
-                           for response in self.get_multi(result)]
+    def snapshot(self) -> KonlIndexSnapshot:
+        # every write lands under the commit lock, so views opened under it never see half a document
+        with self._commit_lock:
+            return KonlIndexSnapshot(self)
 
-        return [tokens_with_id[0] for tokens_with_id in tokens_with_ids
-                if utility.is_sorted([tokens_with_id[1].index(token) for token in sanitized_tokens])]
+    def delete(self, document_id) -> None:
+        get_response = self.get(document_id)
 
-    def __tokenize_with_order(self, document) -> typing.List[str]:
-        sanitized_document = self.sanitize(document)
-        return [token for token in list(mecab.morphs(sanitized_document)) if self.is_indexable(token)]
+        if get_response.status_code != GetStatusCode.SUCCESS:
+            raise KeyError
 
-    def search_suggestions(self, prefix: str) -> typing.List[str]:
-        return self._inverted_index.search_suggestions(prefix)
+        document_hash = self.generate_hash(get_response.result.document)
+        token_name = self.build_token_name(document_id)
+        tokens = self._format.decode_tokens(self._cf[token_name])
+
+        with self._locks.acquire([document_hash, *tokens]):
+            document_id_key = self.build_key_name(document_id)
+
+            if document_id_key not in self._document_cf:
+                raise KeyError
+
+            # the counters are shared with every writer, so they are only read and written under the commit lock
+            with self._commit_lock:
+                self._inverted_index.delete(document_id, tokens)
+                self.delete_document_hash(document_hash)
+
+                self._cf.delete(token_name)
+
+                length_name = self.build_length_name(document_id)
+                self._cf[self._length_prefix] = max(self.get_total_length() - self.get_length(document_id), 0)
+                self._cf.delete(length_name)
+
+                self._document_cf.delete(document_id_key)
+
+                size = self.__len__()
+                if size > 0:
+                    self.__set_len(size-1)
+
+    def commit(self, wb: rocksdict.WriteBatch):
+        with self._commit_lock:
+            self._cf.write(wb)
+
+        self._inverted_index.invalidate_cache(wb)
+
+    def rollback(self, wb: rocksdict.WriteBatch):
+        wb.clear()
+        self._inverted_index.discard_pending_tokens(wb)
+
+    def get_value(self, key: typing.Union[str, bytes], default=None):
+        return self._cf.get(key, default)
+
+    def get_documents(self, keys: typing.List[typing.Union[str, bytes]]) -> typing.List[typing.Optional[str]]:
+        return self._document_cf[keys]
+
+    def get_document_iter(self) -> rocksdict.RdictIter:
+        return self._document_cf.iter()
+
+    def get_inverted_index_view(self) -> KonlInvertedIndexView:
+        return self._inverted_index.to_view()
+
+    def get_trie_view(self) -> KonlTrie:
+        return self._inverted_index.get_trie()
+
+    def suggest(self, prefix: str, k: int = 10, order: SuggestionOrder = SuggestionOrder.FREQUENCY) -> typing.List[str]:
+        return self._inverted_index.suggest(prefix, k, order)
+
+    def aggregate_frequency(self):
+        self._inverted_index.aggregate_frequency()
+
+    def start_frequency_aggregation(self, interval: float):
+        self._inverted_index.start_frequency_aggregation(interval)
+
+    def stop_frequency_aggregation(self):
+        self._inverted_index.stop_frequency_aggregation()
+
+    def get_cache_stats(self) -> CacheStats:
+        return self._inverted_index.get_cache_stats()
 
     def close(self):
+        self.__close_document_store()
+        self._cf_handle = None
         self._cf.close()
         self._inverted_index.close()
 
-    def __len__(self):
-        key = self._len_prefix
+    def __close_document_store(self):
+        if self._document_cf is not self._cf:
+            self._document_cf.close()
 
-        if key in self._cf:
-            return self._cf[key]
-        else:
-            return 0
+        self._document_cf_handle = None
 
     def __set_len(self, size: int):
         self._cf[self._len_prefix] = size
-
-    def __remove_prefix(self, key_with_prefix: str) -> int:
-        document_id_x = key_with_prefix.replace(self._prefix + ":", "")
-        return int(document_id_x, 16)
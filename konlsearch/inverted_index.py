@@ -1,20 +1,33 @@
 from __future__ import annotations
 
+import array
+import collections
 import datetime
+import heapq
 import rocksdict
+import threading
 import typing
 import enum
 
 from strenum import StrEnum
 
+from . import posting
 from . import utility
+from .cache import CachedPostings, CacheStats, KonlPostingCache
+from .format import StorageFormat
+from .ranking import TermPostings
 
-from .log import KonlSearchLog
-from .set import KonlSet, KonlSetView, KonlSetWriteBatch
-from .trie import KonlTrie
+from .log import KonlSearchLog, KonlSearchLogBuffer, SearchLogBufferOptions, SearchLogResponse
+from .posting import KonlPostingListView, KonlPostingListWriteBatch
+from .scheduler import KonlScheduler
+from .term import KonlTermDictionary, build_term_key
+from .trie import SUGGESTION_TOP_K, KonlTrie, SuggestionOrder
 
 
 _LOG_OFFSET = "log:offset"
+_PROBE_RATIO = posting.BLOCK_SIZE
+_POSTING_CACHE_SIZE = 64 * 1024 * 1024
+_AGGREGATE_CHUNK_SIZE = 10000
 
 
 class TokenSearchMode(StrEnum):
@@ -24,108 +37,427 @@ class TokenSearchMode(StrEnum):
 
 
 class KonlInvertedIndexWriteBatch:
-    def __init__(self, inverted_index: KonlInvertedIndex, wb: rocksdict.WriteBatch):
+    def __init__(self, inverted_index: KonlInvertedIndex, wb: rocksdict.WriteBatch, deferred_trie: bool = False):
+        self._inverted_index = inverted_index
         self._iter = inverted_index._cf.iter()
         self._wb = wb
-        self._cf_handle = inverted_index._cf.get_column_family_handle(inverted_index._name)
-        self._trie_wb = inverted_index._trie.to_write_batch(wb)
+        self._cf_handle = inverted_index._cf_handle
+        self._trie_wb = inverted_index._trie.to_write_batch(wb, deferred_trie)
+        self._postings = {}
 
-    def index(self, document_id: int, tokens: typing.Set[str]):
-        for token in tokens:
-            s_wb = KonlSetWriteBatch(self._wb, self._cf_handle, token)
-            s_wb.add(str(document_id))
+    def finalize(self):
+        self._trie_wb.finalize()
 
-        for token in tokens:
-            self._trie_wb.insert(token)
+    def index(self, document_id: int, tokens: typing.Union[typing.Set[str], typing.Dict[str, int]],
+              positions: typing.Optional[typing.Dict[str, typing.List[int]]] = None):
+        frequencies = tokens if isinstance(tokens, dict) else dict.fromkeys(tokens, 1)
+        positions = positions or {}
+        posting_keys = self._inverted_index.get_posting_keys(frequencies, True)
+
+        for token, frequency in frequencies.items():
+            self.get_posting_list(token, posting_keys[token]).add(document_id, frequency, positions.get(token, ()))
+
+        self._trie_wb.index(frequencies)
 
     def delete(self, document_id: int, tokens: typing.Set[str]) -> None:
+        posting_keys = self._inverted_index.get_posting_keys(tokens)
+
         for token in tokens:
-            s = KonlSetView(self._iter, token)
-            s_wb = KonlSetWriteBatch(self._wb, self._cf_handle, token)
-            s_wb.remove(str(document_id))
+            p_wb = self.get_posting_list(token, posting_keys[token])
+            p_wb.remove(document_id)
 
-            if document_id in s and len(s) == 1:
+            if len(p_wb) == 0:
                 self._trie_wb.delete(token)
 
+    def get_posting_list(self, token: str, posting_key: typing.Optional[str] = None) -> KonlPostingListWriteBatch:
+        if token not in self._postings:
+            if posting_key is None:
+                posting_key = self._inverted_index.get_posting_keys([token], True)[token]
+
+            self._postings[token] = KonlPostingListWriteBatch(self._wb, self._cf_handle, self._iter, posting_key)
+            self._inverted_index.add_pending_token(self._wb, token)
+
+        return self._postings[token]
+
+
+class KonlInvertedIndexView:
+    def __init__(self, inverted_index: KonlInvertedIndex, iter: rocksdict.RdictIter,
+                 cache: typing.Optional[KonlPostingCache] = None, generation: int = 0):
+        self._inverted_index = inverted_index
+        self._iter = iter
+        self._cache = cache
+        self._generation = generation
+
+    def search(self, tokens: typing.List[str], mode: TokenSearchMode) -> typing.List[int]:
+        return self.search_array(tokens, mode).tolist()
+
+    def count(self, tokens: typing.List[str], mode: TokenSearchMode) -> int:
+        posting_keys = self._inverted_index.get_posting_keys(tokens)
+        sizes = {token: len(KonlPostingListView(self._iter, posting_keys[token])) for token in tokens}
+
+        if mode == TokenSearchMode.AND and (not sizes or min(sizes.values()) == 0):
+            return 0
+
+        non_empty_tokens = [token for token, size in sizes.items() if size]
+
+        # a single list is answered from its stored document frequency
+        if len(non_empty_tokens) <= 1:
+            return sum(sizes.values())
+
+        if mode == TokenSearchMode.OR:
+            return posting.count_union([self.__get_postings(token, posting_keys[token]).document_ids
+                                        for token in non_empty_tokens])
+
+        return len(self.__search_array(tokens, mode, False))
+
+    def search_array(self, tokens: typing.List[str], mode: TokenSearchMode, log: bool = True) -> array.array:
+        return self.__search_array(tokens, mode, log)
+
+    def __search_array(self, tokens: typing.List[str], mode: TokenSearchMode, log: bool) -> array.array:
+        posting_keys = self._inverted_index.get_posting_keys(tokens)
+        postings = []
+
+        for token in tokens:
+            cached = self.__get_cached(token)
+            p = KonlPostingListView(self._iter, posting_keys[token]) if cached is None else cached.document_ids
+            size = len(p)
+
+            if size and log:
+                self._inverted_index.log_search(token)
+
+            postings.append((size, token, p))
+
+        if mode == TokenSearchMode.OR:
+            return posting.union([self.__to_array(token, p) for size, token, p in postings if size]
+                                 or [posting.new_array()])
+
+        postings.sort(key=lambda x: x[0])
+
+        if not postings or postings[0][0] == 0:
+            return posting.new_array()
+
+        result = self.__to_array(postings[0][1], postings[0][2])
+
+        for size, token, p in postings[1:]:
+            if not result:
+                break
+
+            # probing blocks through the skip keys beats decoding a list much longer than the candidates
+            if isinstance(p, KonlPostingListView) and size > len(result) * _PROBE_RATIO:
+                result = p.intersect(result)
+            else:
+                result = posting.intersect(result, self.__to_array(token, p))
+
+        return result
+
+    def __to_array(self, token: str, p: typing.Union[KonlPostingListView, array.array]) -> array.array:
+        if isinstance(p, array.array):
+            return p
+
+        return self.__load_postings(token, p).document_ids
+
+    def __get_cached(self, token: str) -> typing.Optional[CachedPostings]:
+        # a snapshot reads no cache, since the cache always holds the latest postings
+        return self._cache.get(token) if self._cache is not None else None
+
+    def __get_postings(self, token: str, posting_key: str) -> CachedPostings:
+        cached = self.__get_cached(token)
+
+        if cached is not None:
+            return cached
+
+        return self.__load_postings(token, KonlPostingListView(self._iter, posting_key))
+
+    def __load_postings(self, token: str, p: KonlPostingListView) -> CachedPostings:
+        document_ids, frequencies = p.to_arrays()
+        postings = CachedPostings(document_ids=document_ids, frequencies=frequencies,
+                                  max_frequency=max(frequencies, default=0))
+
+        if document_ids and self._cache is not None:
+            self._cache.put(token, postings, self._generation)
+
+        return postings
+
+    def iter_search(self, tokens: typing.List[str], mode: TokenSearchMode, after_id: typing.Optional[int] = None,
+                    log: bool = True) -> typing.Generator[int, None, None]:
+        start_id = None if after_id is None else after_id + 1
+        posting_keys = self._inverted_index.get_posting_keys(tokens)
+        postings = []
+
+        # the lists below are consumed interleaved, which is safe because each of them repositions the shared iterator
+        for token in tokens:
+            p = KonlPostingListView(self._iter, posting_keys[token])
+            size = len(p)
+
+            if size and log:
+                self._inverted_index.log_search(token)
+
+            postings.append((size, p))
+
+        if mode == TokenSearchMode.OR:
+            yield from utility.unique_sorted(heapq.merge(*[p.items(start_id) for size, p in postings if size]))
+            return
+
+        postings.sort(key=lambda x: x[0])
+
+        if not postings or postings[0][0] == 0:
+            return
+
+        for candidates in utility.batched(postings[0][1].items(start_id), posting.BLOCK_SIZE):
+            result = posting.new_array(candidates)
+
+            for size, p in postings[1:]:
+                if not result:
+                    break
+
+                result = p.intersect(result)
+
+            yield from result
+
+    def get_term_postings(self, tokens: typing.List[str]) -> typing.List[TermPostings]:
+        posting_keys = self._inverted_index.get_posting_keys(tokens)
+        result = []
+
+        for token in dict.fromkeys(tokens):
+            p = self.__get_postings(token, posting_keys[token])
+
+            if p.document_ids:
+                self._inverted_index.log_search(token)
+                result.append(TermPostings(document_ids=p.document_ids, frequencies=p.frequencies,
+                                           max_frequency=p.max_frequency))
+
+        return result
+
+    def get_positions(self, tokens: typing.List[str], document_ids: typing.Iterable[int]) \
+            -> typing.Dict[str, typing.Dict[int, typing.List[int]]]:
+        posting_keys = self._inverted_index.get_posting_keys(tokens)
+
+        return {token: KonlPostingListView(self._iter, posting_key).get_positions(document_ids)
+                for token, posting_key in posting_keys.items()}
+
 
 class KonlInvertedIndex:
-    def __init__(self, db: rocksdict.Rdict, name: str):
+    def __init__(self, db: rocksdict.Rdict, name: str, cache_size: int = _POSTING_CACHE_SIZE,
+                 log_buffer_options: typing.Optional[SearchLogBufferOptions] = None,
+                 options: typing.Optional[rocksdict.Options] = None,
+                 storage_format: StorageFormat = StorageFormat.V1, suggestion_top_k: int = SUGGESTION_TOP_K,
+                 commit_lock: typing.Optional[threading.Lock] = None):
         self._db = db
         self._name = self.__build_inverted_index_name(name)
-        self._cf = utility.create_or_get_cf(db, self._name)
-        self._trie = KonlTrie(db, name)
-        self._log = KonlSearchLog(self._cf)
-        self._log_offset = self._cf[_LOG_OFFSET] if _LOG_OFFSET in self._cf else None
+        self._cf = utility.create_or_get_cf(db, self._name, options)
+        self._cf_handle = db.get_column_family_handle(self._name)
+        self._trie = KonlTrie(db, name, top_k=suggestion_top_k, options=options)
+        self._terms = KonlTermDictionary(self._cf, self._cf_handle)
+        self._storage_format = storage_format
+        self._log = KonlSearchLog(self._cf, self._cf_handle)
+        self._log_buffer = KonlSearchLogBuffer(self._log, log_buffer_options) if log_buffer_options else None
+        self._log_offset = KonlSearchLog.convert_seq_id(self._cf.get(_LOG_OFFSET))
+        self._cache = KonlPostingCache(cache_size)
+        self._pending_tokens: typing.Dict[int, typing.Set[str]] = {}
+        self._pending_lock = threading.Lock()
+        self._aggregate_lock = threading.Lock()
+        self._commit_lock = threading.Lock() if commit_lock is None else commit_lock
+        self._aggregate_scheduler: typing.Optional[KonlScheduler] = None
 
     def __getitem__(self, token: str) -> typing.Set[int]:
-        s = KonlSetView(self._cf.iter(), token)
+        p = KonlPostingListView(self._cf.iter(), self.get_posting_keys([token])[token])
 
-        return {int(e) for e in s.items()}
+        return set(p.items())
 
     def __contains__(self, token: str) -> bool:
-        s = KonlSetView(self._cf.iter(), token)
+        p = KonlPostingListView(self._cf.iter(), self.get_posting_keys([token])[token])
 
-        return len(s) > 0
+        return not p.is_empty()
 
     def close(self):
+        self.stop_frequency_aggregation()
+
+        if self._log_buffer is not None:
+            self._log_buffer.close()
+
+        self._log.close()
+        self._terms.close()
+        self._cf_handle = None
         self._cf.close()
         self._trie.close()
 
-    def to_write_batch(self, wb: rocksdict.WriteBatch):
-        return KonlInvertedIndexWriteBatch(self, wb)
+    def to_write_batch(self, wb: rocksdict.WriteBatch, deferred_trie: bool = False):
+        return KonlInvertedIndexWriteBatch(self, wb, deferred_trie)
+
+    def to_view(self, iter: typing.Optional[rocksdict.RdictIter] = None) -> KonlInvertedIndexView:
+        if iter is not None:
+            return KonlInvertedIndexView(self, iter)
+
+        # the generation is read before the iterator, so postings loaded from an older view are never cached
+        generation = self._cache.get_generation()
+
+        return KonlInvertedIndexView(self, self._cf.iter(), self._cache, generation)
+
+    def get_trie(self) -> KonlTrie:
+        return self._trie
+
+    def get_term_dictionary(self) -> KonlTermDictionary:
+        return self._terms
+
+    def get_storage_format(self) -> StorageFormat:
+        return self._storage_format
+
+    def set_storage_format(self, storage_format: StorageFormat):
+        self._storage_format = storage_format
+        self._cache.clear()
+
+    def get_posting_keys(self, tokens: typing.Iterable[str], create: bool = False) -> typing.Dict[str, str]:
+        if self._storage_format == StorageFormat.V1:
+            return {token: token for token in tokens}
+
+        term_ids = self._terms.get_or_create_ids(tokens) if create else self._terms.get_ids(tokens)
+
+        # an unknown token reads the posting list of term 0, which is never assigned and so always empty
+        return {token: build_term_key(term_ids.get(token, 0)) for token in tokens}
+
+    def add_pending_token(self, wb, token: str) -> None:
+        with self._pending_lock:
+            self._pending_tokens.setdefault(id(wb), set()).add(token)
+
+    def invalidate_cache(self, wb) -> None:
+        with self._pending_lock:
+            tokens = self._pending_tokens.pop(id(wb), ())
+
+        self._cache.invalidate(tokens)
+
+    def discard_pending_tokens(self, wb) -> None:
+        with self._pending_lock:
+            self._pending_tokens.pop(id(wb), None)
+
+    def get_cache_stats(self) -> CacheStats:
+        return self._cache.get_stats()
 
-    def index(self, document_id: int, tokens: typing.Set[str]):
+    def index(self, document_id: int, tokens: typing.Union[typing.Set[str], typing.Dict[str, int]],
+              positions: typing.Optional[typing.Dict[str, typing.List[int]]] = None):
         wb = rocksdict.WriteBatch()
-        cf_handle = self._db.get_column_family_handle(self._name)
+        iter = self._cf.iter()
+        frequencies = tokens if isinstance(tokens, dict) else dict.fromkeys(tokens, 1)
+        positions = positions or {}
+        posting_keys = self.get_posting_keys(frequencies, True)
 
-        for token in tokens:
-            s_wb = KonlSetWriteBatch(wb, cf_handle, token)
-            s_wb.add(str(document_id))
+        for token, frequency in frequencies.items():
+            p_wb = KonlPostingListWriteBatch(wb, self._cf_handle, iter, posting_keys[token])
+            p_wb.add(document_id, frequency, positions.get(token, ()))
 
-            self._trie.insert(token)
+        self._trie.to_write_batch(wb).index(frequencies)
 
         self._cf.write(wb)
+        self._cache.invalidate(frequencies)
 
     def delete(self, document_id: int, tokens: typing.Set[str]) -> None:
+        wb = rocksdict.WriteBatch()
+        iter = self._cf.iter()
+        empty_tokens = []
+        posting_keys = self.get_posting_keys(tokens)
+
         for token in tokens:
-            s = KonlSet(self._cf, token)
-            s.remove(str(document_id))
+            p_wb = KonlPostingListWriteBatch(wb, self._cf_handle, iter, posting_keys[token])
+            p_wb.remove(document_id)
+
+            if len(p_wb) == 0:
+                empty_tokens.append(token)
 
-            if len(s) == 0:
-                self._trie.delete(token)
+        self._cf.write(wb)
+        self._cache.invalidate(tokens)
+
+        for token in empty_tokens:
+            self._trie.delete(token)
 
-    # noinspection PyBroadException
     def search(self, tokens: typing.List[str], mode: TokenSearchMode) -> typing.List[int]:
-        result_set = set()
+        return self.to_view().search(tokens, mode)
 
-        iter = self._cf.iter()
+    def count(self, tokens: typing.List[str], mode: TokenSearchMode) -> int:
+        return self.to_view().count(tokens, mode)
 
-        for i, token in enumerate(tokens):
-            s = KonlSetView(iter, token)
+    def search_array(self, tokens: typing.List[str], mode: TokenSearchMode, log: bool = True) -> array.array:
+        return self.to_view().search_array(tokens, mode, log)
 
-            document_ids = {int(e) for e in s.items()}
+    def iter_search(self, tokens: typing.List[str], mode: TokenSearchMode, after_id: typing.Optional[int] = None,
+                    log: bool = True) -> typing.Generator[int, None, None]:
+        return self.to_view().iter_search(tokens, mode, after_id, log)
 
-            if document_ids:
-                self._log.append(token, 1)
+    def log_search(self, token: str) -> None:
+        if self._log_buffer is not None:
+            self._log_buffer.append(token, 1)
+        else:
+            self._log.append(token, 1)
 
-            if mode == TokenSearchMode.OR or i == 0:
-                result_set.update(document_ids)
-            elif mode == TokenSearchMode.AND:
-                result_set.intersection_update(document_ids)
+    def get_term_postings(self, tokens: typing.List[str]) -> typing.List[TermPostings]:
+        return self.to_view().get_term_postings(tokens)
 
-        return sorted(list(result_set))
+    def get_positions(self, tokens: typing.List[str], document_ids: typing.Iterable[int]) \
+            -> typing.Dict[str, typing.Dict[int, typing.List[int]]]:
+        return self.to_view().get_positions(tokens, document_ids)
 
     def search_suggestions(self, prefix: str) -> typing.List[str]:
-        return self._trie.to_view().search(prefix)
+        return self._trie.search(prefix)
+
+    def suggest(self, prefix: str, k: int, order: SuggestionOrder) -> typing.List[str]:
+        return self._trie.suggest(prefix, k, order)
+
+    def aggregate_frequency(self, chunk_size: int = _AGGREGATE_CHUNK_SIZE):
+        with self._aggregate_lock:
+            if self._log_buffer is not None:
+                # every entry numbered before last_seq_id is already in the buffer, so one flush makes it visible
+                last_seq_id = self._log_buffer.generate_seq_id()
+                self._log_buffer.flush()
+            else:
+                # appends write their entry under the log lock, so every id below last_seq_id is already stored
+                last_seq_id = self._log.generate_seq_id()
+
+            first_seq_id = self._log_offset or self._log.get_first_seq_id()
+
+            if first_seq_id is None:
+                return
+
+            chunks = utility.batched(self._log.iter_range_seq_id(first_seq_id, last_seq_id), chunk_size)
+            chunk = next(chunks, None)
+
+            while chunk:
+                next_chunk = next(chunks, None)
+
+                # the offset is written with the frequencies so a chunk is never applied twice
+                self.__aggregate_chunk(chunk, next_chunk[0].seq_id if next_chunk else last_seq_id)
+
+                chunk = next_chunk
+
+            if self._log_offset != last_seq_id:
+                self._cf[_LOG_OFFSET] = last_seq_id
+                self._log_offset = last_seq_id
+
+    def __aggregate_chunk(self, entries: typing.List[SearchLogResponse], offset: str):
+        frequencies = collections.Counter()
+
+        for entry in entries:
+            frequencies[entry.token] += entry.size
+
+        # the trie counters are shared with the index writers, so they are read and written under their commit lock
+        with self._commit_lock:
+            wb = rocksdict.WriteBatch()
+
+            self._trie.to_write_batch(wb).increase_frequencies(frequencies)
+            wb.put(_LOG_OFFSET, offset, self._cf_handle)
+
+            self._cf.write(wb)
+
+        self._log_offset = offset
 
-    def aggregate_frequency(self):
-        first_seq_id = self._log_offset or self._log.get_first_seq_id()
-        last_seq_id = self._log.generate_seq_id()
+    def start_frequency_aggregation(self, interval: float, chunk_size: int = _AGGREGATE_CHUNK_SIZE):
+        self.stop_frequency_aggregation()
 
-        for entry in self._log.get_range_seq_id(first_seq_id, last_seq_id):
-            self._trie.increase_frequency(entry.token, entry.size)
+        self._aggregate_scheduler = KonlScheduler(interval, lambda: self.aggregate_frequency(chunk_size),
+                                                  f'{self._name}-aggregation')
+        self._aggregate_scheduler.start()
 
-        self._cf[_LOG_OFFSET] = last_seq_id
+    def stop_frequency_aggregation(self):
+        if self._aggregate_scheduler is not None:
+            self._aggregate_scheduler.stop()
+            self._aggregate_scheduler = None
 
     @staticmethod
     def __build_inverted_index_name(name: str) -> str:
@@ -1,6 +1,7 @@
+import contextlib
 import threading
 
-from typing import Union
+from typing import Iterable, Iterator, Union
 
 AbcLock = Union[threading.Lock, threading.RLock]
 LockType = Union[type(threading.Lock), type(threading.RLock)]
@@ -16,3 +17,23 @@ class StripedLock:
 
     def get(self, s: str) -> AbcLock:
         return self._locks[hash(s) % self.size]
+
+    def acquire(self, keys: Iterable[str]) -> contextlib.AbstractContextManager:
+        return self.__acquire(sorted({hash(k) % self.size for k in keys}))
+
+    def acquire_all(self) -> contextlib.AbstractContextManager:
+        return self.__acquire(range(self.size))
+
+    @contextlib.contextmanager
+    def __acquire(self, stripes: Iterable[int]) -> Iterator[None]:
+        locks = [self._locks[stripe] for stripe in stripes]
+
+        # stripes are always taken in ascending order, so two writers can never deadlock on each other
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
@@ -1,10 +1,29 @@
+from __future__ import annotations
+
 from dataclasses import dataclass
-import datetime
-import itertools
+import random
+import re
+import threading
+import time
 import typing
 
 import rocksdict
 
+from .scheduler import KonlScheduler
+
+
+_TIMESTAMP_DIGITS = 12
+_LOGICAL_DIGITS = 4
+_NODE_DIGITS = 4
+_MAX_LOGICAL = 16 ** _LOGICAL_DIGITS - 1
+_LOG_PREFIX = "__access__"
+_LEGACY_LOG_PREFIX = "access"
+_UPGRADE_BATCH_SIZE = 10000
+_SEQ_ID_PATTERN = re.compile(r'[0-9a-f]{20}')
+_LEGACY_SEQ_ID_PATTERN = re.compile(r'([0-9]+):([0-9]+)')
+_KEY_PATTERN = re.compile(r'([0-9a-f]{20}):(.*)', re.DOTALL)
+_LEGACY_KEY_PATTERN = re.compile(r'([0-9]+:[0-9]+|[0-9a-f]{20}):(.*)', re.DOTALL)
+
 
 @dataclass
 class SearchLogRequest:
@@ -19,33 +38,112 @@ class SearchLogResponse:
     token: str
 
 
+@dataclass
+class SearchLogBufferOptions:
+    flush_size: int = 1000
+    flush_interval: float = 1.0
+    sample_rate: float = 1.0
+    max_size: int = 100000
+
+
 class KonlSearchLog:
-    def __init__(self, cf: rocksdict.Rdict):
+    def __init__(self, cf: rocksdict.Rdict, cf_handle: typing.Optional[rocksdict.ColumnFamily] = None,
+                 node_id: typing.Optional[int] = None):
         self._cf = cf
-        self._prefix = "access"
-        self._last_second = int(datetime.datetime.now().timestamp())
-        self._seq_count_generator = itertools.count(1)
+        self._cf_handle = cf_handle
+        # no indexable token contains an underscore, so no posting key can fall into the log range
+        self._prefix = _LOG_PREFIX
+        self._node_id = random.getrandbits(_NODE_DIGITS * 4) if node_id is None else node_id
+        self._lock = threading.Lock()
+        self._last_timestamp = 0
+        self._logical = 0
+
+        self.__upgrade_legacy_entries()
+
+        last_seq_id = self.get_last_seq_id()
+
+        if last_seq_id is not None:
+            self._last_timestamp, self._logical, _ = self.parse_seq_id(last_seq_id)
+
+    def close(self):
+        self._cf_handle = None
+
+    def generate_seq_id(self) -> str:
+        with self._lock:
+            return self.__next_seq_id()
+
+    def __next_seq_id(self) -> str:
+        timestamp = time.time_ns() // 1000000
+
+        # hybrid logical clock: never goes backwards, and the logical part orders ids within one millisecond
+        if timestamp > self._last_timestamp:
+            self._last_timestamp = timestamp
+            self._logical = 0
+        elif self._logical < _MAX_LOGICAL:
+            self._logical += 1
+        else:
+            self._last_timestamp += 1
+            self._logical = 0
+
+        return self.build_seq_id(self._last_timestamp, self._logical, self._node_id)
+
+    def __observe(self, seq_id: str):
+        timestamp, logical, _ = self.parse_seq_id(seq_id)
+
+        if (timestamp, logical) > (self._last_timestamp, self._logical):
+            self._last_timestamp, self._logical = timestamp, logical
+
+    @staticmethod
+    def build_seq_id(timestamp: int, logical: int = 0, node_id: int = 0) -> str:
+        return (f'{timestamp:x}'.rjust(_TIMESTAMP_DIGITS, '0') + f'{logical:x}'.rjust(_LOGICAL_DIGITS, '0')
+                + f'{node_id:x}'.rjust(_NODE_DIGITS, '0'))
 
-    def generate_seq_id(self) -> int:
-        ts = int(datetime.datetime.now().timestamp())
+    @staticmethod
+    def convert_seq_id(seq_id: typing.Optional[str]) -> typing.Optional[str]:
+        # ids written as seconds:counter before the clock existed map onto the same order, anything else is dropped
+        if not isinstance(seq_id, str):
+            return None
+
+        if _SEQ_ID_PATTERN.fullmatch(seq_id):
+            return seq_id
+
+        match = _LEGACY_SEQ_ID_PATTERN.fullmatch(seq_id)
+
+        if match is None:
+            return None
 
-        if self._last_second != ts:
-            self._seq_count_generator = itertools.count(1)
-            self._last_second = ts
+        return KonlSearchLog.build_seq_id(int(match[1]) * 1000, min(int(match[2]), _MAX_LOGICAL))
 
-        seq_count_s = str(next(self._seq_count_generator)).rjust(4, '0')
+    @staticmethod
+    def parse_seq_id(seq_id: str) -> tuple[int, int, int]:
+        logical_offset = _TIMESTAMP_DIGITS + _LOGICAL_DIGITS
 
-        return f'{ts}:{seq_count_s}'
+        return (int(seq_id[:_TIMESTAMP_DIGITS], 16), int(seq_id[_TIMESTAMP_DIGITS:logical_offset], 16),
+                int(seq_id[logical_offset:], 16))
 
     def append(self, token: str, size: int) -> None:
-        seq_id = self.generate_seq_id()
-        key = self.__build_key_name(seq_id, token)
-        self._cf[key] = size
+        # the id is published together with its entry, so an id handed out later is never written before it
+        with self._lock:
+            key = self.__build_key_name(self.__next_seq_id(), token)
+            self._cf[key] = size
 
     def append_multi(self, requests: typing.List[SearchLogRequest]):
         for request in requests:
             self.append(request.token, request.size)
 
+    def write(self, entries: typing.List[SearchLogResponse]) -> None:
+        wb = rocksdict.WriteBatch()
+
+        for entry in entries:
+            wb.put(self.__build_key_name(entry.seq_id, entry.token), entry.size, self._cf_handle)
+
+        # ids from another clock move this one forward, so every id generated afterwards sorts above them
+        with self._lock:
+            for entry in entries:
+                self.__observe(entry.seq_id)
+
+            self._cf.write(wb)
+
     def get_range(self, start_timestamp: int, end_timestamp: int) -> typing.List[SearchLogResponse]:
         if end_timestamp <= start_timestamp:
             return []
@@ -71,8 +169,11 @@ class KonlSearchLog:
         return result
 
     def get_range_seq_id(self, start_seq_id: str, end_seq_id: str) -> typing.List[SearchLogResponse]:
+        return list(self.iter_range_seq_id(start_seq_id, end_seq_id))
+
+    def iter_range_seq_id(self, start_seq_id: str, end_seq_id: str) -> typing.Generator[SearchLogResponse, None, None]:
         if end_seq_id <= start_seq_id:
-            return []
+            return
 
         it = self._cf.iter()
 
@@ -81,59 +182,155 @@ class KonlSearchLog:
 
         it.seek(start_key)
 
-        result = []
-
         while it.valid() and type(it.key()) == str and it.key().startswith(self._prefix) and it.key() < end_key:
-            r = SearchLogResponse(
+            yield SearchLogResponse(
                 seq_id=self.__get_seq_id_from_key(it.key()),
                 token=self.__get_token_from_key(it.key()),
                 size=it.value()
             )
-            result.append(r)
             it.next()
 
-        return result
-
     def get_first_seq_id(self) -> typing.Optional[str]:
         it = self._cf.iter()
 
-        it.seek(self._prefix)
+        it.seek(self._prefix + ":")
 
-        if it.valid() and type(it.key()) == str and it.key().startswith(self._prefix):
-            return self.__get_seq_id_from_key(it.key())
-        else:
-            return None
+        while it.valid() and self.__is_log_key(it.key()):
+            match = _KEY_PATTERN.fullmatch(it.key(), len(self._prefix) + 1)
+
+            if match is not None:
+                return match[1]
+
+            it.next()
+
+        return None
 
     def get_last_seq_id(self) -> typing.Optional[str]:
         it = self._cf.iter()
 
-        it.seek(self._prefix)
+        it.seek_for_prev(self._prefix + ";")
+
+        while it.valid() and self.__is_log_key(it.key()):
+            match = _KEY_PATTERN.fullmatch(it.key(), len(self._prefix) + 1)
+
+            if match is not None:
+                return match[1]
+
+            it.prev()
+
+        return None
+
+    def __is_log_key(self, key) -> bool:
+        return isinstance(key, str) and key.startswith(self._prefix + ":")
+
+    def __upgrade_legacy_entries(self):
+        it = self._cf.iter()
+        legacy_prefix = _LEGACY_LOG_PREFIX + ":"
+        entries = []
+
+        # older logs lived under access:, which v1 postings of the token "access" share; both id formats start
+        # with a digit, so only that part of the range is read and every key is matched exactly
+        it.seek(legacy_prefix + "0")
+
+        while it.valid() and type(it.key()) == str and legacy_prefix + "0" <= it.key() < legacy_prefix + ":":
+            key = it.key()
+            match = _LEGACY_KEY_PATTERN.fullmatch(key, len(legacy_prefix))
+            seq_id = self.convert_seq_id(match[1]) if match is not None else None
+
+            if seq_id is not None:
+                entries.append((key, self.__build_key_name(seq_id, match[2]), it.value()))
+
+            if len(entries) >= _UPGRADE_BATCH_SIZE:
+                self.__move(entries)
+                entries = []
 
-        while it.valid() and type(it.key()) == str and it.key().startswith(self._prefix):
             it.next()
 
-        it.prev()
+        self.__move(entries)
 
-        if it.valid() and type(it.key()) == str and it.key().startswith(self._prefix):
-            return self.__get_seq_id_from_key(it.key())
-        else:
-            return None
+    def __move(self, entries: typing.List[tuple[str, str, typing.Any]]):
+        if self._cf_handle is None:
+            for key, new_key, value in entries:
+                self._cf[new_key] = value
+                self._cf.delete(key)
+
+            return
+
+        wb = rocksdict.WriteBatch()
+
+        for key, new_key, value in entries:
+            wb.put(new_key, value, self._cf_handle)
+            wb.delete(key, self._cf_handle)
+
+        self._cf.write(wb)
 
     def __build_key_id(self, timestamp: int) -> str:
-        return f'{self._prefix}:{timestamp}'
+        return self.__build_key_seq_id(self.build_seq_id(timestamp * 1000))
 
     def __build_key_seq_id(self, seq_id: str) -> str:
         return f'{self._prefix}:{seq_id}'
 
-    def __build_key_name(self, seq_id: int, token: str) -> str:
-        return f'{self.__build_key_id(seq_id)}:{token}'
-
-    def __get_timestamp_from_key(self, key_with_prefix: str) -> str:
-        return key_with_prefix.split(":")[1]
+    def __build_key_name(self, seq_id: str, token: str) -> str:
+        return f'{self.__build_key_seq_id(seq_id)}:{token}'
 
     def __get_token_from_key(self, key_with_prefix: str) -> str:
-        return key_with_prefix.split(":")[3]
+        return key_with_prefix.split(":", 2)[2]
 
     def __get_seq_id_from_key(self, key_with_prefix: str) -> str:
-        parts = key_with_prefix.split(":")
-        return f'{parts[1]}:{parts[2]}'
+        return key_with_prefix.split(":", 2)[1]
+
+
+class KonlSearchLogBuffer:
+    def __init__(self, log: KonlSearchLog, options: SearchLogBufferOptions):
+        self._log = log
+        self._options = options
+        self._entries: typing.List[SearchLogResponse] = []
+        self._dropped_count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._random = random.Random()
+        self._scheduler = KonlScheduler(options.flush_interval, self.flush, "search-log-buffer")
+        self._scheduler.start()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_dropped_count(self) -> int:
+        return self._dropped_count
+
+    def generate_seq_id(self) -> str:
+        with self._lock:
+            return self._log.generate_seq_id()
+
+    def append(self, token: str, size: int) -> None:
+        sample_rate = self._options.sample_rate
+
+        if sample_rate < 1.0:
+            if self._random.random() >= sample_rate:
+                return
+
+            # a sampled entry stands in for the ones that were skipped
+            size = max(1, round(size / sample_rate))
+
+        with self._lock:
+            if len(self._entries) >= self._options.max_size:
+                self._dropped_count += 1
+                return
+
+            self._entries.append(SearchLogResponse(seq_id=self._log.generate_seq_id(), size=size, token=token))
+
+            if len(self._entries) >= self._options.flush_size:
+                self._scheduler.trigger()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                entries = self._entries
+                self._entries = []
+
+            if entries:
+                self._log.write(entries)
+
+    def close(self) -> None:
+        self._scheduler.stop()
+        self.flush()
@@ -0,0 +1,206 @@
+import argparse
+import typing
+
+import rocksdict
+
+from . import utility
+from .format import KonlDocumentFormat, StorageFormat, build_document_store_name, get_document_format
+from .index import KonlIndex
+from .inverted_index import KonlInvertedIndex
+from .search import KonlSearch
+from .term import KonlTermDictionary, build_term_key, is_term_key, parse_term_key
+
+
+_MIGRATE_BATCH_SIZE = 10000
+
+_DocumentStore = typing.Tuple[rocksdict.Rdict, rocksdict.ColumnFamily]
+
+
+def migrate_index(index: KonlIndex, storage_format: StorageFormat = StorageFormat.V2,
+                  batch_size: int = _MIGRATE_BATCH_SIZE) -> int:
+    with index._locks.acquire_all():
+        inverted_index = index._inverted_index
+        terms = inverted_index.get_term_dictionary()
+        source = index._format
+
+        if source.storage_format == storage_format:
+            # a migration interrupted after the switch still has source keys left to delete
+            for other_format in StorageFormat:
+                if other_format == storage_format:
+                    continue
+
+                # opening a store creates its column family, so one that never existed is left alone
+                if _has_document_store(index, other_format):
+                    other_store = index.open_document_store(other_format)
+
+                    _delete_documents(index, get_document_format(index._name, other_format, terms), other_store,
+                                      batch_size)
+                    _close_document_store(index, other_store)
+
+                _delete_postings(inverted_index, other_format, batch_size)
+
+            return 0
+
+        target = get_document_format(index._name, storage_format, terms)
+        source_store = index.open_document_store(source.storage_format)
+        target_store = index.open_document_store(storage_format)
+
+        # everything is copied before the switch and deleted after it, so an interrupted migration can be rerun
+        count = _copy_documents(index, source, source_store, target, target_store, batch_size)
+        _copy_postings(inverted_index, terms, source.storage_format, storage_format, batch_size)
+        index.set_storage_format(storage_format)
+        _delete_documents(index, source, source_store, batch_size)
+        _delete_postings(inverted_index, source.storage_format, batch_size)
+
+        _close_document_store(index, source_store)
+        _close_document_store(index, target_store)
+
+        return count
+
+
+def convert_legacy_postings(index: KonlIndex, batch_size: int = _MIGRATE_BATCH_SIZE) -> int:
+    return index.convert_legacy_postings(batch_size)
+
+
+def migrate(path: str, storage_format: StorageFormat = StorageFormat.V2,
+            batch_size: int = _MIGRATE_BATCH_SIZE) -> typing.Dict[str, int]:
+    ks = KonlSearch(path)
+    result = {}
+
+    try:
+        for name in ks.get_all_indexes():
+            index = ks.index(name)
+
+            try:
+                result[name] = migrate_index(index, storage_format, batch_size)
+            finally:
+                index.close()
+    finally:
+        ks.close()
+
+    return result
+
+
+def _copy_documents(index: KonlIndex, source: KonlDocumentFormat, source_store: _DocumentStore,
+                    target: KonlDocumentFormat, target_store: _DocumentStore, batch_size: int) -> int:
+    count = 0
+
+    for batch in utility.batched(_iter_documents(source, source_store), batch_size):
+        wb = rocksdict.WriteBatch()
+
+        for document_id, document in batch:
+            tokens = index._cf.get(source.build_tokens_key(document_id))
+            length = index._cf.get(source.build_length_key(document_id))
+
+            wb.put(target.build_document_key(document_id), target.encode_document(source.decode_document(document)),
+                   target_store[1])
+
+            if tokens is not None:
+                wb.put(target.build_tokens_key(document_id), target.encode_tokens(source.decode_tokens(tokens)),
+                       index._cf_handle)
+
+            if length is not None:
+                wb.put(target.build_length_key(document_id), target.encode_length(source.decode_length(length)),
+                       index._cf_handle)
+
+        index._cf.write(wb)
+        count += len(batch)
+
+    return count
+
+
+def _delete_documents(index: KonlIndex, source: KonlDocumentFormat, source_store: _DocumentStore, batch_size: int):
+    for batch in utility.batched(_iter_documents(source, source_store), batch_size):
+        wb = rocksdict.WriteBatch()
+
+        for document_id, _ in batch:
+            wb.delete(source.build_document_key(document_id), source_store[1])
+            wb.delete(source.build_tokens_key(document_id), index._cf_handle)
+            wb.delete(source.build_length_key(document_id), index._cf_handle)
+
+        index._cf.write(wb)
+
+
+def _copy_postings(inverted_index: KonlInvertedIndex, terms: KonlTermDictionary, source: StorageFormat,
+                   target: StorageFormat, batch_size: int):
+    for batch in utility.batched(_iter_postings(inverted_index, source), batch_size):
+        posting_keys = [parts[0] for parts, _ in batch]
+
+        if source == StorageFormat.V1:
+            term_ids = terms.get_or_create_ids(posting_keys)
+            target_keys = {token: build_term_key(term_ids[token]) for token in posting_keys}
+        else:
+            tokens = terms.get_tokens(parse_term_key(posting_key) for posting_key in posting_keys)
+            target_keys = {posting_key: tokens[parse_term_key(posting_key)] for posting_key in posting_keys}
+
+        wb = rocksdict.WriteBatch()
+
+        for (posting_key, kind, suffix), value in batch:
+            wb.put(f'{target_keys[posting_key]}:{kind}:{suffix}', value, inverted_index._cf_handle)
+
+        inverted_index._cf.write(wb)
+
+
+def _delete_postings(inverted_index: KonlInvertedIndex, source: StorageFormat, batch_size: int):
+    for batch in utility.batched(_iter_postings(inverted_index, source), batch_size):
+        wb = rocksdict.WriteBatch()
+
+        for parts, _ in batch:
+            wb.delete(':'.join(parts), inverted_index._cf_handle)
+
+        inverted_index._cf.write(wb)
+
+
+def _iter_postings(inverted_index: KonlInvertedIndex, source: StorageFormat) \
+        -> typing.Generator[tuple[typing.List[str], typing.Any], None, None]:
+    it = inverted_index._cf.iter()
+    it.seek_to_first()
+
+    # posting keys are {token}:posting:{block}, {token}:position:{block} and {token}:__len__:posting,
+    # where the token is replaced by its term key in v2
+    while it.valid():
+        key = it.key()
+
+        if isinstance(key, str):
+            parts = key.split(":", 2)
+
+            if len(parts) == 3 and (parts[1] in ("posting", "position") or parts[1:] == ["__len__", "posting"]) \
+                    and is_term_key(parts[0]) == (source == StorageFormat.V2):
+                yield parts, it.value()
+
+        it.next()
+
+
+def _has_document_store(index: KonlIndex, storage_format: StorageFormat) -> bool:
+    if storage_format == StorageFormat.V1:
+        return True
+
+    return build_document_store_name(index._name) in rocksdict.Rdict.list_cf(index._db.path())
+
+
+def _close_document_store(index: KonlIndex, store: _DocumentStore):
+    if store[0] is not index._cf:
+        store[0].close()
+
+
+def _iter_documents(source: KonlDocumentFormat, source_store: _DocumentStore) \
+        -> typing.Generator[tuple[int, typing.Any], None, None]:
+    it = source_store[0].iter()
+    it.seek(source.get_document_prefix())
+
+    while it.valid() and source.is_document_key(it.key()):
+        yield source.parse_document_key(it.key()), it.value()
+        it.next()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts every index of a KonlSearch database to another storage format")
+    parser.add_argument("path")
+    parser.add_argument("--storage-format", type=StorageFormat, default=StorageFormat.V2,
+                        choices=list(StorageFormat))
+    parser.add_argument("--batch-size", type=int, default=_MIGRATE_BATCH_SIZE)
+
+    args = parser.parse_args()
+
+    for name, count in migrate(args.path, args.storage_format, args.batch_size).items():
+        print(f'{name}: {count} documents')
@@ -0,0 +1,505 @@
+import abc
+import array
+import bisect
+import heapq
+import itertools
+import struct
+import typing
+
+import rocksdict
+
+from . import utility
+
+
+BLOCK_SIZE = 128
+
+_HEADER = struct.Struct('>HQI')
+_GALLOP_RATIO = 16
+
+
+def new_array(document_ids: typing.Iterable[int] = ()) -> array.array:
+    return array.array('Q', document_ids)
+
+
+def intersect(a: array.array, b: array.array) -> array.array:
+    if len(a) > len(b):
+        a, b = b, a
+
+    if not a:
+        return new_array()
+
+    if len(b) < len(a) * _GALLOP_RATIO:
+        return new_array(utility.intersect_sorted(a, b))
+
+    result = new_array()
+    lo = 0
+
+    for document_id in a:
+        lo = bisect.bisect_left(b, document_id, lo)
+
+        if lo == len(b):
+            break
+
+        if b[lo] == document_id:
+            result.append(document_id)
+
+    return result
+
+
+def union(arrays: typing.List[array.array]) -> array.array:
+    if len(arrays) == 1:
+        return arrays[0]
+
+    # the inputs are already sorted, so a k-way merge keeps them sorted without hashing every id
+    return new_array(utility.unique_sorted(heapq.merge(*arrays)))
+
+
+def count_union(arrays: typing.List[array.array]) -> int:
+    if len(arrays) == 1:
+        return len(arrays[0])
+
+    return sum(1 for _ in utility.unique_sorted(heapq.merge(*arrays)))
+
+
+def encode_varint(value: int, buffer: bytearray) -> None:
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    buffer.append(value)
+
+
+def decode_varints(data: bytes, offset: int = 0) -> typing.List[int]:
+    result = []
+    value = 0
+    shift = 0
+
+    for i in range(offset, len(data)):
+        b = data[i]
+        value |= (b & 0x7f) << shift
+
+        if b & 0x80:
+            shift += 7
+        else:
+            result.append(value)
+            value = 0
+            shift = 0
+
+    return result
+
+
+def encode_block(block_id: int, document_ids: typing.List[int], frequencies: typing.List[int]) -> bytes:
+    buffer = bytearray(_HEADER.pack(len(document_ids), document_ids[-1], max(frequencies)))
+    previous = block_id
+
+    for document_id, frequency in zip(document_ids, frequencies):
+        encode_varint(document_id - previous, buffer)
+        encode_varint(frequency, buffer)
+        previous = document_id
+
+    return bytes(buffer)
+
+
+def decode_block(block_id: int, value: bytes) -> typing.List[int]:
+    return decode_block_with_frequencies(block_id, value)[0]
+
+
+def decode_block_with_frequencies(block_id: int, value: bytes) -> tuple[typing.List[int], typing.List[int]]:
+    values = decode_varints(value, _HEADER.size)
+    document_ids = list(itertools.accumulate(values[0::2], initial=block_id))[1:]
+
+    return document_ids, values[1::2]
+
+
+def append_block(value: bytes, document_id: int, frequency: int) -> bytes:
+    count, last_document_id, max_frequency = _HEADER.unpack_from(value)
+    buffer = bytearray(_HEADER.pack(count + 1, document_id, max(max_frequency, frequency)))
+    buffer += value[_HEADER.size:]
+    encode_varint(document_id - last_document_id, buffer)
+    encode_varint(frequency, buffer)
+
+    return bytes(buffer)
+
+
+def get_block_count(value: bytes) -> int:
+    return _HEADER.unpack_from(value)[0]
+
+
+def get_block_last(value: bytes) -> int:
+    return _HEADER.unpack_from(value)[1]
+
+
+def get_block_max_frequency(value: bytes) -> int:
+    return _HEADER.unpack_from(value)[2]
+
+
+def encode_positions(position_lists: typing.List[typing.List[int]]) -> bytes:
+    buffer = bytearray()
+
+    for positions in position_lists:
+        encode_varint(len(positions), buffer)
+        previous = 0
+
+        for position in positions:
+            encode_varint(position - previous, buffer)
+            previous = position
+
+    return bytes(buffer)
+
+
+def decode_positions(value: bytes) -> typing.List[typing.List[int]]:
+    values = decode_varints(value)
+    result = []
+    i = 0
+
+    while i < len(values):
+        count = values[i]
+        result.append(list(itertools.accumulate(values[i + 1:i + 1 + count])))
+        i += count + 1
+
+    return result
+
+
+class AbstractKonlPostingList(abc.ABC):
+    def build_key_name(self, block_id: int) -> str:
+        block_id_s = f'{block_id:x}'.rjust(10, '0')
+        return f'{self._prefix}:{block_id_s}'
+
+    def build_position_key_name(self, block_id: int) -> str:
+        block_id_s = f'{block_id:x}'.rjust(10, '0')
+        return f'{self._position_prefix}:{block_id_s}'
+
+    def get_block_id(self, key_with_prefix: str) -> int:
+        return int(key_with_prefix[len(self._prefix) + 1:], 16)
+
+    def is_block_key(self, key) -> bool:
+        return isinstance(key, str) and key.startswith(self._prefix + ":")
+
+
+class KonlPostingListReader(AbstractKonlPostingList):
+    def __len__(self) -> int:
+        it = self._iter
+        it.seek(self._len_prefix)
+
+        if it.valid() and it.key() == self._len_prefix:
+            return it.value()
+
+        # lists written before the document frequency was stored
+        return sum(get_block_count(value) for _, value in self.blocks())
+
+    def __contains__(self, document_id: int) -> bool:
+        for block_id, value in self.blocks(document_id):
+            return block_id <= document_id <= get_block_last(value) and document_id in decode_block(block_id, value)
+
+        return False
+
+    def is_empty(self) -> bool:
+        for _ in self.blocks():
+            return False
+
+        return True
+
+    def to_array(self) -> array.array:
+        result = new_array()
+
+        for block_id, value in self.blocks():
+            result.extend(decode_block(block_id, value))
+
+        return result
+
+    def to_arrays(self) -> tuple[array.array, array.array]:
+        document_ids = new_array()
+        frequencies = new_array()
+
+        for block_id, value in self.blocks():
+            block_document_ids, block_frequencies = decode_block_with_frequencies(block_id, value)
+            document_ids.extend(block_document_ids)
+            frequencies.extend(block_frequencies)
+
+        return document_ids, frequencies
+
+    def max_frequency(self) -> int:
+        return max((get_block_max_frequency(value) for _, value in self.blocks()), default=0)
+
+    def intersect(self, document_ids: typing.Iterable[int]) -> array.array:
+        result = new_array()
+        block = set()
+        block_last = -1
+
+        for document_id in document_ids:
+            if document_id > block_last:
+                for block_id, value in self.blocks(document_id):
+                    block = set(decode_block(block_id, value))
+                    block_last = get_block_last(value)
+                    break
+                else:
+                    break
+
+            if document_id in block:
+                result.append(document_id)
+
+        return result
+
+    def get_positions(self, document_ids: typing.Iterable[int]) -> typing.Dict[int, typing.List[int]]:
+        result = {}
+        block = {}
+        block_last = -1
+
+        for document_id in document_ids:
+            if document_id > block_last:
+                for block_id, value in self.blocks(document_id):
+                    position_lists = self.__get_position_lists(block_id, get_block_count(value))
+                    block = dict(zip(decode_block(block_id, value), position_lists))
+                    block_last = get_block_last(value)
+                    break
+                else:
+                    break
+
+            if document_id in block:
+                result[document_id] = block[document_id]
+
+        return result
+
+    def __get_position_lists(self, block_id: int, count: int) -> typing.List[typing.List[int]]:
+        key = self.build_position_key_name(block_id)
+
+        self._iter.seek(key)
+
+        if self._iter.valid() and self._iter.key() == key:
+            return decode_positions(self._iter.value())
+
+        return [[] for _ in range(count)]
+
+    def items(self, start_id: typing.Optional[int] = None) -> typing.Generator[int, None, None]:
+        for block_id, value in self.blocks(start_id):
+            for document_id in decode_block(block_id, value):
+                if start_id is None or document_id >= start_id:
+                    yield document_id
+
+    def blocks(self, start_id: typing.Optional[int] = None) -> typing.Generator[tuple[int, bytes], None, None]:
+        it = self._iter
+
+        if start_id is not None:
+            it.seek_for_prev(self.build_key_name(start_id))
+
+            if not (it.valid() and self.is_block_key(it.key())):
+                it.seek(self._prefix)
+        else:
+            it.seek(self._prefix)
+
+        while it.valid() and self.is_block_key(it.key()):
+            key = it.key()
+
+            yield self.get_block_id(key), it.value()
+
+            # lists read interleaved share one iterator, so it is moved back when another list used it in between
+            if not (it.valid() and it.key() == key):
+                it.seek(key)
+
+            it.next()
+
+
+class KonlPostingListView(KonlPostingListReader):
+    def __init__(self, iter: rocksdict.RdictIter, token: str):
+        self._iter = iter
+        self._prefix = f'{token}:posting'
+        self._position_prefix = f'{token}:position'
+        self._len_prefix = f'{token}:__len__:posting'
+
+
+class KonlPostingListWriteBatch(AbstractKonlPostingList):
+    def __init__(self, wb: rocksdict.WriteBatch, cf_handle: rocksdict.ColumnFamily, iter: rocksdict.RdictIter,
+                 token: str):
+        self._wb = wb
+        self._cf_handle = cf_handle
+        self._iter = iter
+        self._prefix = f'{token}:posting'
+        self._position_prefix = f'{token}:position'
+        self._len_prefix = f'{token}:__len__:posting'
+        self._view = KonlPostingListView(iter, token)
+        self._blocks: typing.Dict[int, typing.Optional[tuple[bytes, bytes]]] = {}
+        self._block_ids: typing.List[int] = []
+        self._size: typing.Optional[int] = None
+
+    def __len__(self) -> int:
+        # the view reads the state before this batch, and every change made through the batch is counted on top of it
+        if self._size is None:
+            self._size = len(self._view)
+
+        return self._size
+
+    def add(self, document_id: int, frequency: int = 1, positions: typing.List[int] = ()) -> None:
+        if self.__add(document_id, frequency, positions):
+            self.__set_len(len(self) + 1)
+
+    def remove(self, document_id: int) -> None:
+        if self.__remove(document_id):
+            self.__set_len(len(self) - 1)
+
+    def __set_len(self, size: int) -> None:
+        self._size = size
+
+        if size > 0:
+            self._wb.put(self._len_prefix, size, self._cf_handle)
+        else:
+            self._wb.delete(self._len_prefix, self._cf_handle)
+
+    def __add(self, document_id: int, frequency: int, positions: typing.List[int]) -> bool:
+        block_id = self.__get_floor_block_id(document_id)
+
+        if block_id is None:
+            block_id = self.__get_first_block_id()
+
+        if block_id is None:
+            self.__put_new_block(document_id, frequency, positions)
+            return True
+
+        value, position_value = self.__get_block(block_id)
+        count, last_document_id, _ = _HEADER.unpack_from(value)
+
+        if document_id > last_document_id:
+            if count < BLOCK_SIZE:
+                self.__put_block(block_id, append_block(value, document_id, frequency),
+                                 position_value + encode_positions([positions]))
+            else:
+                self.__put_new_block(document_id, frequency, positions)
+
+            return True
+
+        document_ids, frequencies = decode_block_with_frequencies(block_id, value)
+        position_lists = decode_positions(position_value)
+        i = bisect.bisect_left(document_ids, document_id)
+
+        if i < len(document_ids) and document_ids[i] == document_id:
+            return False
+
+        document_ids.insert(i, document_id)
+        frequencies.insert(i, frequency)
+        position_lists.insert(i, list(positions))
+
+        if document_id < block_id:
+            self.__delete_block(block_id)
+            block_id = document_id
+
+        if len(document_ids) > BLOCK_SIZE:
+            half = len(document_ids) // 2
+            self.__put_block(block_id, encode_block(block_id, document_ids[:half], frequencies[:half]),
+                             encode_positions(position_lists[:half]))
+            self.__put_block(document_ids[half], encode_block(document_ids[half], document_ids[half:], frequencies[half:]),
+                             encode_positions(position_lists[half:]))
+        else:
+            self.__put_block(block_id, encode_block(block_id, document_ids, frequencies), encode_positions(position_lists))
+
+        return True
+
+    def __remove(self, document_id: int) -> bool:
+        block_id = self.__get_floor_block_id(document_id)
+
+        if block_id is None:
+            return False
+
+        value, position_value = self.__get_block(block_id)
+        document_ids, frequencies = decode_block_with_frequencies(block_id, value)
+
+        if document_id not in document_ids:
+            return False
+
+        position_lists = decode_positions(position_value)
+
+        i = document_ids.index(document_id)
+        del document_ids[i]
+        del frequencies[i]
+        del position_lists[i]
+
+        if document_ids:
+            self.__put_block(block_id, encode_block(block_id, document_ids, frequencies), encode_positions(position_lists))
+        else:
+            self.__delete_block(block_id)
+
+        return True
+
+    def update(self, document_ids: typing.Iterable[int]) -> None:
+        for document_id in document_ids:
+            self.add(document_id)
+
+    def is_empty(self) -> bool:
+        return self.__get_first_block_id() is None
+
+    def __get_block(self, block_id: int) -> tuple[bytes, bytes]:
+        if block_id in self._blocks:
+            return self._blocks[block_id]
+
+        self._iter.seek(self.build_key_name(block_id))
+        value = self._iter.value()
+
+        position_key = self.build_position_key_name(block_id)
+        self._iter.seek(position_key)
+
+        if self._iter.valid() and self._iter.key() == position_key:
+            position_value = self._iter.value()
+        else:
+            position_value = encode_positions([[] for _ in range(get_block_count(value))])
+
+        return value, position_value
+
+    def __put_new_block(self, document_id: int, frequency: int, positions: typing.List[int]) -> None:
+        self.__put_block(document_id, encode_block(document_id, [document_id], [frequency]), encode_positions([positions]))
+
+    def __put_block(self, block_id: int, value: bytes, position_value: bytes) -> None:
+        if block_id not in self._blocks:
+            bisect.insort(self._block_ids, block_id)
+
+        self._blocks[block_id] = value, position_value
+        self._wb.put(self.build_key_name(block_id), value, self._cf_handle)
+        self._wb.put(self.build_position_key_name(block_id), position_value, self._cf_handle)
+
+    def __delete_block(self, block_id: int) -> None:
+        if block_id not in self._blocks:
+            bisect.insort(self._block_ids, block_id)
+
+        self._blocks[block_id] = None
+        self._wb.delete(self.build_key_name(block_id), self._cf_handle)
+        self._wb.delete(self.build_position_key_name(block_id), self._cf_handle)
+
+    def __get_floor_block_id(self, document_id: int) -> typing.Optional[int]:
+        pending_block_id = None
+
+        for i in range(bisect.bisect_right(self._block_ids, document_id) - 1, -1, -1):
+            if self._blocks[self._block_ids[i]] is not None:
+                pending_block_id = self._block_ids[i]
+                break
+
+        it = self._iter
+        it.seek_for_prev(self.build_key_name(document_id))
+
+        while it.valid() and self.is_block_key(it.key()):
+            block_id = self.get_block_id(it.key())
+
+            if pending_block_id is not None and block_id <= pending_block_id:
+                break
+
+            if block_id not in self._blocks or self._blocks[block_id] is not None:
+                return block_id
+
+            it.prev()
+
+        return pending_block_id
+
+    def __get_first_block_id(self) -> typing.Optional[int]:
+        pending_block_id = next((block_id for block_id in self._block_ids if self._blocks[block_id] is not None), None)
+
+        it = self._iter
+        it.seek(self._prefix)
+
+        while it.valid() and self.is_block_key(it.key()):
+            block_id = self.get_block_id(it.key())
+
+            if pending_block_id is not None and block_id >= pending_block_id:
+                break
+
+            if block_id not in self._blocks or self._blocks[block_id] is not None:
+                return block_id
+
+            it.next()
+
+        return pending_block_id
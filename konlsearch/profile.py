@@ -0,0 +1,113 @@
+from dataclasses import dataclass
+import enum
+import typing
+
+import rocksdict
+from strenum import StrEnum
+
+
+_MB = 1024 * 1024
+_DOCUMENT_DICT_SIZE = 16 * 1024
+_DOCUMENT_TRAIN_SIZE = 100 * _DOCUMENT_DICT_SIZE
+
+
+class StorageProfile(StrEnum):
+    BULK_LOAD = enum.auto()
+    SERVING = enum.auto()
+    LOW_MEMORY = enum.auto()
+
+
+@dataclass
+class StorageProfileSettings:
+    block_cache_size: int
+    write_buffer_size: int
+    db_write_buffer_size: int
+    max_write_buffer_number: int
+    bloom_bits_per_key: float
+    max_background_jobs: int
+    level_zero_file_num_compaction_trigger: int
+    max_open_files: int
+
+
+_PROFILE_SETTINGS = {
+    StorageProfile.BULK_LOAD: StorageProfileSettings(
+        block_cache_size=64 * _MB,
+        write_buffer_size=256 * _MB,
+        db_write_buffer_size=1024 * _MB,
+        max_write_buffer_number=4,
+        bloom_bits_per_key=10,
+        max_background_jobs=8,
+        level_zero_file_num_compaction_trigger=16,
+        max_open_files=-1
+    ),
+    StorageProfile.SERVING: StorageProfileSettings(
+        block_cache_size=512 * _MB,
+        write_buffer_size=64 * _MB,
+        db_write_buffer_size=512 * _MB,
+        max_write_buffer_number=3,
+        bloom_bits_per_key=10,
+        max_background_jobs=4,
+        level_zero_file_num_compaction_trigger=4,
+        max_open_files=-1
+    ),
+    StorageProfile.LOW_MEMORY: StorageProfileSettings(
+        block_cache_size=8 * _MB,
+        write_buffer_size=8 * _MB,
+        db_write_buffer_size=32 * _MB,
+        max_write_buffer_number=2,
+        bloom_bits_per_key=10,
+        max_background_jobs=2,
+        level_zero_file_num_compaction_trigger=4,
+        max_open_files=256
+    ),
+}
+
+
+def get_profile_settings(profile: StorageProfile) -> StorageProfileSettings:
+    return _PROFILE_SETTINGS[profile]
+
+
+def build_table_options(profile: typing.Union[StorageProfile, StorageProfileSettings]) -> rocksdict.BlockBasedOptions:
+    settings = profile if isinstance(profile, StorageProfileSettings) else get_profile_settings(profile)
+
+    table_options = rocksdict.BlockBasedOptions()
+    table_options.set_block_cache(rocksdict.Cache(settings.block_cache_size))
+    table_options.set_bloom_filter(settings.bloom_bits_per_key, False)
+    table_options.set_cache_index_and_filter_blocks(True)
+    table_options.set_pin_l0_filter_and_index_blocks_in_cache(True)
+
+    return table_options
+
+
+def apply_profile(options: rocksdict.Options, profile: typing.Union[StorageProfile, StorageProfileSettings],
+                  table_options: typing.Optional[rocksdict.BlockBasedOptions] = None) -> rocksdict.Options:
+    settings = profile if isinstance(profile, StorageProfileSettings) else get_profile_settings(profile)
+
+    # one table factory, and so one block cache, is shared by every column family given the same table options
+    options.set_block_based_table_factory(build_table_options(settings) if table_options is None else table_options)
+    options.set_write_buffer_size(settings.write_buffer_size)
+    options.set_db_write_buffer_size(settings.db_write_buffer_size)
+    options.set_max_write_buffer_number(settings.max_write_buffer_number)
+    options.set_max_background_jobs(settings.max_background_jobs)
+    options.set_level_zero_file_num_compaction_trigger(settings.level_zero_file_num_compaction_trigger)
+    options.set_level_compaction_dynamic_level_bytes(True)
+    options.set_max_open_files(settings.max_open_files)
+    options.set_memtable_prefix_bloom_ratio(0.02)
+    options.set_memtable_whole_key_filtering(True)
+
+    return options
+
+
+def build_document_options(profile: typing.Union[StorageProfile, StorageProfileSettings, None] = None,
+                           table_options: typing.Optional[rocksdict.BlockBasedOptions] = None) -> rocksdict.Options:
+    options = rocksdict.Options()
+
+    if profile is not None:
+        apply_profile(options, profile, table_options)
+
+    # each file gets a zstd dictionary trained on a sample of its documents, so short similar bodies compress together
+    options.set_compression_type(rocksdict.DBCompressionType.zstd())
+    options.set_compression_options(-14, 3, 0, _DOCUMENT_DICT_SIZE)
+    options.set_zstd_max_train_bytes(_DOCUMENT_TRAIN_SIZE)
+
+    return options
@@ -0,0 +1,130 @@
+from dataclasses import dataclass
+import array
+import bisect
+import heapq
+import itertools
+import math
+import typing
+
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+@dataclass
+class TermPostings:
+    document_ids: array.array
+    frequencies: array.array
+    max_frequency: int
+
+
+def idf(document_count: int, document_frequency: int) -> float:
+    return math.log(1 + (document_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+
+def bm25(term_idf: float, frequency: int, length: int, average_length: float) -> float:
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+
+    return term_idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+
+def bm25_upper_bound(term_idf: float, max_frequency: int) -> float:
+    return term_idf * max_frequency * (BM25_K1 + 1) / (max_frequency + BM25_K1 * (1 - BM25_B))
+
+
+def top_k(postings: typing.List[TermPostings], k: int, document_count: int, average_length: float,
+          get_length: typing.Callable[[int], int]) -> typing.List[tuple[float, int]]:
+    terms = _build_terms(postings, document_count)
+
+    if k <= 0 or not terms:
+        return []
+
+    # MaxScore: terms sorted by their upper bound, so a prefix of them cannot lift a document into the top k alone
+    terms.sort(key=lambda term: term[0])
+    upper_bounds = [term[0] for term in terms]
+    prefix_bounds = [0.0] + list(itertools.accumulate(upper_bounds))
+
+    heap: typing.List[tuple[float, int]] = []
+    threshold = 0.0
+    first_essential = 0
+    positions = [0] * len(terms)
+
+    while (next_candidate := _next_candidate(terms, positions, first_essential)) is not None:
+        candidate, matched = next_candidate
+        bound = sum(upper_bounds[i] for i, _ in matched) + prefix_bounds[first_essential]
+
+        if len(heap) == k and bound <= threshold:
+            continue
+
+        length = get_length(candidate)
+        score = sum(bm25(terms[i][1], terms[i][2].frequencies[position], length, average_length)
+                    for i, position in matched)
+        score = _score_non_essential(terms, first_essential, candidate, score, length, average_length,
+                                     prefix_bounds, threshold if len(heap) == k else None)
+
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -candidate))
+        elif score > threshold:
+            heapq.heapreplace(heap, (score, -candidate))
+        else:
+            continue
+
+        if len(heap) == k:
+            threshold = heap[0][0]
+
+            while first_essential < len(terms) and prefix_bounds[first_essential + 1] <= threshold:
+                first_essential += 1
+
+    return [(score, -negative_id) for score, negative_id in sorted(heap, reverse=True)]
+
+
+def _build_terms(postings: typing.List[TermPostings], document_count: int) \
+        -> typing.List[tuple[float, float, TermPostings]]:
+    terms = []
+
+    for p in postings:
+        if len(p.document_ids) == 0:
+            continue
+
+        term_idf = idf(document_count, len(p.document_ids))
+        terms.append((bm25_upper_bound(term_idf, p.max_frequency), term_idf, p))
+
+    return terms
+
+
+def _next_candidate(terms: typing.List[tuple[float, float, TermPostings]], positions: typing.List[int],
+                    first_essential: int) -> typing.Optional[tuple[int, typing.List[tuple[int, int]]]]:
+    # the next document is the smallest one left in the essential lists, which are all moved past it
+    candidate = min((terms[i][2].document_ids[positions[i]] for i in range(first_essential, len(terms))
+                     if positions[i] < len(terms[i][2].document_ids)), default=None)
+
+    if candidate is None:
+        return None
+
+    matched = []
+
+    for i in range(first_essential, len(terms)):
+        document_ids = terms[i][2].document_ids
+
+        if positions[i] < len(document_ids) and document_ids[positions[i]] == candidate:
+            matched.append((i, positions[i]))
+            positions[i] += 1
+
+    return candidate, matched
+
+
+def _score_non_essential(terms: typing.List[tuple[float, float, TermPostings]], first_essential: int, candidate: int,
+                         score: float, length: int, average_length: float, prefix_bounds: typing.List[float],
+                         threshold: typing.Optional[float]) -> float:
+    # the non-essential lists are probed from the highest bound down, until the rest cannot reach the threshold
+    for i in range(first_essential - 1, -1, -1):
+        if threshold is not None and score + prefix_bounds[i + 1] <= threshold:
+            break
+
+        document_ids = terms[i][2].document_ids
+        position = bisect.bisect_left(document_ids, candidate)
+
+        if position < len(document_ids) and document_ids[position] == candidate:
+            score += bm25(terms[i][1], terms[i][2].frequencies[position], length, average_length)
+
+    return score
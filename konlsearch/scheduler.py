@@ -0,0 +1,54 @@
+import logging
+import threading
+import typing
+
+
+_logger = logging.getLogger(__name__)
+
+
+class KonlScheduler:
+    def __init__(self, interval: float, task: typing.Callable[[], None], name: typing.Optional[str] = None):
+        self._interval = interval
+        self._task = task
+        self._name = name
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.is_running():
+            return
+
+        self._stopped.clear()
+        self._wakeup.clear()
+        self._thread = threading.Thread(target=self.__run, name=self._name, daemon=True)
+        self._thread.start()
+
+    def trigger(self) -> None:
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def __run(self) -> None:
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+            if self._stopped.is_set():
+                break
+
+            # a failing run is logged and retried on the next tick instead of killing the thread
+            try:
+                self._task()
+            except Exception:
+                _logger.exception("scheduled task %s failed", self._name)
@@ -1,10 +1,15 @@
 import enum
+import os
 import typing
 
 import rocksdict
 from strenum import StrEnum
 
+from .format import StorageFormat, is_document_store_name
 from .index import KonlIndex
+from .log import SearchLogBufferOptions
+from .profile import StorageProfile, apply_profile, build_document_options, build_table_options
+from .trie import SUGGESTION_TOP_K
 
 
 class AccessType(StrEnum):
@@ -13,24 +18,38 @@ class AccessType(StrEnum):
 
 
 class KonlSearch:
-    def __init__(self, path: str, access_type: AccessType = AccessType.READ_WRITE):
+    def __init__(self, path: str, access_type: AccessType = AccessType.READ_WRITE,
+                 profile: typing.Optional[StorageProfile] = None, options: typing.Optional[rocksdict.Options] = None):
         self.path = path
-        self.options = rocksdict.Options()
+        self.options = rocksdict.Options() if options is None else options
         self.options.create_if_missing(True)
         self.options.create_missing_column_families(True)
 
+        # the document store shares the index's block cache, so a profile's memory budget covers both
+        table_options = None if profile is None else build_table_options(profile)
+
+        if profile is not None:
+            apply_profile(self.options, profile, table_options)
+
+        self.document_options = build_document_options(profile, table_options)
+
         access_type = rocksdict.AccessType.read_write() \
             if (access_type == AccessType.READ_WRITE) else rocksdict.AccessType.read_only()
 
-        self.db = rocksdict.Rdict(path=self.path, options=self.options, access_type=access_type)
+        self.db = rocksdict.Rdict(path=self.path, options=self.options, column_families=self.__get_column_families(),
+                                  access_type=access_type)
         self._index_prefix = "index"
 
-    def index(self, name) -> KonlIndex:
+    def index(self, name, storage_format: typing.Optional[StorageFormat] = None,
+              suggestion_top_k: int = SUGGESTION_TOP_K,
+              log_buffer_options: typing.Optional[SearchLogBufferOptions] = None) -> KonlIndex:
         key = self.__build_index_key(name)
 
         self.db.put(key, "1")
 
-        return KonlIndex(self.db, name)
+        return KonlIndex(self.db, name, log_buffer_options=log_buffer_options, options=self.options,
+                         storage_format=storage_format, document_options=self.document_options,
+                         suggestion_top_k=suggestion_top_k)
 
     def get_all_indexes(self) -> typing.List[str]:
         it = self.db.iter()
@@ -50,6 +69,14 @@ class KonlSearch:
     def destroy(self):
         rocksdict.Rdict.destroy(self.path)
 
+    def __get_column_families(self) -> typing.Optional[typing.Dict[str, rocksdict.Options]]:
+        if not os.path.exists(os.path.join(self.path, "CURRENT")):
+            return None
+
+        # existing column families are reopened with the same options instead of the RocksDB defaults
+        return {name: self.document_options if is_document_store_name(name) else self.options
+                for name in rocksdict.Rdict.list_cf(self.path) if name != "default"}
+
     def __build_index_key(self, name: str) -> str:
         return f'{self._index_prefix}:{name}'
 
@@ -11,6 +11,10 @@ class AbstractKonlSet(abc.ABC):
     def remove_prefix(self, key_with_prefix: str) -> str:
         return key_with_prefix.replace(self._prefix + ":", "")
 
+    @staticmethod
+    def build_len_key_name(prefix: str) -> str:
+        return f'{prefix}:__len__:set'
+
 
 class KonlSetReader(AbstractKonlSet):
     @abc.abstractmethod
@@ -18,24 +22,43 @@ class KonlSetReader(AbstractKonlSet):
         pass
 
     def __len__(self) -> int:
-        len = 0
+        size = self.get_stored_len()
+
+        # sets written before the count existed, or by a write batch without a reader, are counted by a scan
+        if size is None:
+            size = sum(1 for _ in self.items())
+
+        return size
+
+    def get_stored_len(self) -> typing.Optional[int]:
+        it = self.__get_iter()
+        it.seek(self._len_prefix)
 
-        for _ in self.items():
-            len += 1
+        if it.valid() and it.key() == self._len_prefix:
+            return it.value()
 
-        return len
+        return None
+
+    def is_empty(self) -> bool:
+        it = self.__get_iter()
+        it.seek(self._prefix + ":")
+
+        return not (it.valid() and type(it.key()) == str and it.key().startswith(self._prefix + ":"))
 
     def items(self) -> typing.Generator[str, None, None]:
-        if hasattr(self, "_iter"):
-            it = self._iter
-        else:
-            it = self._cf.iter()
+        it = self.__get_iter()
         it.seek(self._prefix)
 
         while it.valid() and type(it.key()) == str and it.key().startswith(self._prefix):
             yield self.remove_prefix(it.key())
             it.next()
 
+    def __get_iter(self) -> rocksdict.RdictIter:
+        if hasattr(self, "_iter"):
+            return self._iter
+        else:
+            return self._cf.iter()
+
 
 class KonlSetWriter(AbstractKonlSet):
     @abc.abstractmethod
@@ -55,6 +78,7 @@ class KonlSetView(KonlSetReader):
     def __init__(self, iter: rocksdict.RdictIter, prefix: str):
         self._iter = iter
         self._prefix = f'{prefix}:set'
+        self._len_prefix = self.build_len_key_name(prefix)
 
     def __contains__(self, k: str) -> bool:
         key = self.build_key_name(k)
@@ -65,9 +89,12 @@ class KonlSetView(KonlSetReader):
 
 
 class KonlSet(KonlSetReader, KonlSetWriter):
-    def __init__(self, cf: rocksdict.Rdict, prefix: str):
+    def __init__(self, cf: rocksdict.Rdict, prefix: str, cf_handle: typing.Optional[rocksdict.ColumnFamily] = None):
         self._cf = cf
+        self._cf_handle = cf_handle
+        self._name = prefix
         self._prefix = f'{prefix}:set'
+        self._len_prefix = self.build_len_key_name(prefix)
 
     def __contains__(self, k: str) -> bool:
         key = self.build_key_name(k)
@@ -77,40 +104,106 @@ class KonlSet(KonlSetReader, KonlSetWriter):
     def to_view(self):
         iter = self._cf.iter()
 
-        return KonlSetView(iter, self._prefix)
+        return KonlSetView(iter, self._name)
 
     def add(self, k: str):
         key = self.build_key_name(k)
 
-        self._cf[key] = "1"
+        if key in self._cf:
+            return
+
+        self.__write(key, "1", self.__get_next_len(1))
 
     def remove(self, k: str):
         key = self.build_key_name(k)
 
         if key in self._cf:
-            self._cf.delete(key)
+            self.__write(key, None, self.__get_next_len(-1))
 
     def update(self, s: typing.Set[str]):
         for k in s:
             self.add(k)
 
+    def __get_next_len(self, delta: int) -> typing.Optional[int]:
+        size = self.get_stored_len()
+
+        # an uncounted set is only counted from scratch when it is empty, so a write never has to scan
+        if size is None:
+            if not self.is_empty():
+                return None
+
+            size = 0
+
+        return size + delta
+
+    def __write(self, key: str, value: typing.Optional[str], size: typing.Optional[int]):
+        if self._cf_handle is None:
+            if value is None:
+                self._cf.delete(key)
+            else:
+                self._cf[key] = value
+
+            if size is not None:
+                self._cf[self._len_prefix] = size
+
+            return
+
+        wb = rocksdict.WriteBatch()
+
+        if value is None:
+            wb.delete(key, self._cf_handle)
+        else:
+            wb.put(key, value, self._cf_handle)
+
+        if size is not None:
+            wb.put(self._len_prefix, size, self._cf_handle)
+
+        self._cf.write(wb)
+
 
 class KonlSetWriteBatch(KonlSetWriter):
-    def __init__(self, wb: rocksdict.WriteBatch, cf_handle: rocksdict.ColumnFamily, prefix: str):
+    def __init__(self, wb: rocksdict.WriteBatch, cf_handle: rocksdict.ColumnFamily, prefix: str,
+                 iter: typing.Optional[rocksdict.RdictIter] = None):
         self._wb = wb
         self._cf_handle = cf_handle
         self._prefix = f'{prefix}:set'
+        self._len_prefix = self.build_len_key_name(prefix)
+        self._view = KonlSetView(iter, prefix) if iter is not None else None
+        self._pending: typing.Dict[str, bool] = {}
+        self._size: typing.Optional[int] = None
 
     def add(self, k: str):
         key = self.build_key_name(k)
 
         self._wb.put(key, "1", self._cf_handle)
+        self.__update_len(k, True)
 
     def remove(self, k: str):
         key = self.build_key_name(k)
 
         self._wb.delete(key, self._cf_handle)
+        self.__update_len(k, False)
 
     def update(self, s: typing.Set[str]):
         for k in s:
             self.add(k)
+
+    def __update_len(self, k: str, present: bool):
+        if self._size is None and self._view is not None:
+            self._size = self._view.get_stored_len()
+
+            if self._size is None and self._view.is_empty():
+                self._size = 0
+
+        # without a reader or a stored count the batch cannot keep the count, so it drops it
+        if self._size is None:
+            self._view = None
+            self._wb.delete(self._len_prefix, self._cf_handle)
+            return
+
+        was_present = self._pending[k] if k in self._pending else k in self._view
+
+        self._pending[k] = present
+        self._size += int(present) - int(was_present)
+
+        self._wb.put(self._len_prefix, self._size, self._cf_handle)
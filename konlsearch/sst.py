@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import typing
+
+import rocksdict
+
+
+_DELETED = object()
+_KEY_TYPE_ORDER = {bytes: 0, str: 1}
+
+
+class KonlSstWriteBatch:
+    def __init__(self, column_families: typing.Dict[rocksdict.ColumnFamily, rocksdict.Rdict],
+                 path: typing.Optional[str] = None,
+                 options: typing.Optional[typing.Dict[rocksdict.ColumnFamily, rocksdict.Options]] = None):
+        self._column_families = column_families
+        self._options = {} if options is None else options
+        self._is_temporary = path is None
+        self._path = tempfile.mkdtemp(prefix="konlsearch-") if path is None else path
+        self._pending = {cf_handle: {} for cf_handle in column_families}
+        self._files = {cf_handle: [] for cf_handle in column_families}
+        self._file_count = 0
+
+    def put(self, key, value, column_family: rocksdict.ColumnFamily) -> None:
+        self._pending[column_family][key] = value
+
+    def delete(self, key, column_family: rocksdict.ColumnFamily) -> None:
+        self._pending[column_family][key] = _DELETED
+
+    def flush(self) -> None:
+        for i, (cf_handle, pending) in enumerate(self._pending.items()):
+            if not pending:
+                continue
+
+            os.makedirs(self._path, exist_ok=True)
+
+            path = os.path.join(self._path, f'{i}-{self._file_count}.sst')
+            self._file_count += 1
+
+            # files are written with the target column family's options, so they come out already compressed for it
+            writer = rocksdict.SstFileWriter(self._options.get(cf_handle, rocksdict.Options()))
+            writer.open(path)
+
+            for key in sorted(pending, key=self.sort_key):
+                value = pending[key]
+
+                if value is _DELETED:
+                    del writer[key]
+                else:
+                    writer[key] = value
+
+            writer.finish()
+
+            self._files[cf_handle].append(path)
+            pending.clear()
+
+    def ingest(self) -> None:
+        self.flush()
+
+        options = rocksdict.IngestExternalFileOptions()
+        options.set_move_files(True)
+
+        for cf_handle, cf in self._column_families.items():
+            if self._files[cf_handle]:
+                cf.ingest_external_file(self._files[cf_handle], options)
+
+            self._files[cf_handle] = []
+
+        if self._is_temporary:
+            shutil.rmtree(self._path, ignore_errors=True)
+
+    @staticmethod
+    def sort_key(key) -> tuple[int, typing.Union[bytes, str]]:
+        return _KEY_TYPE_ORDER[type(key)], key
@@ -0,0 +1,93 @@
+import struct
+import threading
+import typing
+
+import rocksdict
+
+from .dict import KonlDict, KonlDictWriteBatch
+
+
+_TERM_ID_FORMAT = '>{}I'
+
+
+def build_term_key(term_id: int) -> str:
+    return '#' + f'{term_id:x}'.rjust(8, '0')
+
+
+def is_term_key(key: str) -> bool:
+    return key.startswith('#')
+
+
+def parse_term_key(key: str) -> int:
+    return int(key[1:], 16)
+
+
+def pack_term_ids(term_ids: typing.Iterable[int]) -> bytes:
+    term_ids = sorted(term_ids)
+
+    return struct.pack(_TERM_ID_FORMAT.format(len(term_ids)), *term_ids)
+
+
+def unpack_term_ids(value: bytes) -> typing.Tuple[int, ...]:
+    return struct.unpack(_TERM_ID_FORMAT.format(len(value) // 4), value)
+
+
+class KonlTermDictionary:
+    def __init__(self, cf: rocksdict.Rdict, cf_handle: rocksdict.ColumnFamily, prefix: str = "term"):
+        self._cf = cf
+        self._cf_handle = cf_handle
+        self._ids_prefix = f'{prefix}_id'
+        self._tokens_prefix = f'{prefix}_token'
+        self._ids = KonlDict(cf, self._ids_prefix)
+        self._tokens = KonlDict(cf, self._tokens_prefix)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get_ids(self, tokens: typing.Iterable[str]) -> typing.Dict[str, int]:
+        tokens = list(dict.fromkeys(tokens))
+        term_ids = self._cf[[self._ids.build_key_name(token) for token in tokens]] if tokens else []
+
+        return {token: term_id for token, term_id in zip(tokens, term_ids) if term_id is not None}
+
+    def get_or_create_ids(self, tokens: typing.Iterable[str]) -> typing.Dict[str, int]:
+        tokens = list(dict.fromkeys(tokens))
+        term_ids = self.get_ids(tokens)
+        missing_tokens = [token for token in tokens if token not in term_ids]
+
+        if not missing_tokens:
+            return term_ids
+
+        # ids are written straight away and never reused, so a rolled back batch only leaves unused terms behind
+        with self._lock:
+            term_ids.update(self.get_ids(missing_tokens))
+
+            wb = rocksdict.WriteBatch()
+            iter = self._cf.iter()
+            ids_wb = KonlDictWriteBatch(wb, self._cf_handle, self._ids_prefix, iter)
+            tokens_wb = KonlDictWriteBatch(wb, self._cf_handle, self._tokens_prefix, iter)
+            next_id = len(self._ids) + 1
+
+            for token in missing_tokens:
+                if token in term_ids:
+                    continue
+
+                term_ids[token] = next_id
+                ids_wb[token] = next_id
+                tokens_wb[build_term_key(next_id)] = token
+                next_id += 1
+
+            self._cf.write(wb)
+
+        return term_ids
+
+    def get_tokens(self, term_ids: typing.Iterable[int]) -> typing.Dict[int, str]:
+        term_ids = list(term_ids)
+        tokens = self._cf[[self._tokens.build_key_name(build_term_key(term_id)) for term_id in term_ids]] \
+            if term_ids else []
+
+        return {term_id: token for term_id, token in zip(term_ids, tokens) if token is not None}
+
+    def close(self):
+        self._cf_handle = None
@@ -1,19 +1,30 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+import enum
+import heapq
+import itertools
 import rocksdict
 import typing
 
+from strenum import StrEnum
+
 from . import utility
-from .counter import KonlCounter
+from .counter import KonlCounter, KonlCounterWriteBatch
 from .dict import KonlDict, KonlDictView, KonlDictWriteBatch, KonlDefaultDict
-from .set import KonlSet, KonlSetView, KonlSetWriteBatch
 
 import hgtk
 
 _TOKEN_DICT = "token_dict"
 _TOKEN_REVERSE_DICT = "token_reverse_dict"
 _TOKEN_FREQUENCY_DICT = "token_frequency_dict"
+SUGGESTION_TOP_K = 10
+_MULTI_GET_SIZE = 10000
+
+
+class SuggestionOrder(StrEnum):
+    FREQUENCY = enum.auto()
+    LEXICAL = enum.auto()
 
 
 @dataclass
@@ -30,111 +41,187 @@ def decompose_word(word: str) -> str:
     return hgtk.text.decompose(text=word, compose_code="")
 
 
+def build_frequency_prefix(decomposed_prefix: str) -> str:
+    return f'freq:{decomposed_prefix}'
+
+
 class KonlTrieView:
     def __init__(self, iter: rocksdict.RdictIter):
         self._iter = iter
         self._token_reverse_dict = KonlDictView(self._iter, _TOKEN_REVERSE_DICT)
 
     def search(self, prefix: str) -> typing.List[str]:
-        decomposed_prefix = decompose_word(prefix)
-
-        return sorted(self.__search(decomposed_prefix))
-
-    def __search(self, decomposed_prefix: str) -> typing.Set[str]:
-        s = KonlSetView(self._iter, decomposed_prefix)
-
-        if len(s) == 0:
-            return set()
+        return sorted(token for _, token in self.items(decompose_word(prefix)))
 
-        result_set = set()
+    def items(self, decomposed_prefix: str) -> typing.Generator[tuple[str, str], None, None]:
+        key_prefix = self._token_reverse_dict.build_key_name(decomposed_prefix)
 
-        if decomposed_prefix in self._token_reverse_dict:
-            result_set.add(self._token_reverse_dict[decomposed_prefix])
+        it = self._iter
+        it.seek(key_prefix)
 
-        candidate_set = set()
-
-        decomposed_prefix_set = KonlSetView(self._iter, decomposed_prefix)
-
-        for s in decomposed_prefix_set.items():
-            candidate_set.add(s)
-
-        for candidate_prefix in candidate_set:
-            if candidate_prefix in self._token_reverse_dict:
-                result_set.add(self._token_reverse_dict[candidate_prefix])
-
-            result_set.update(self.__search(candidate_prefix))
-
-        return result_set
+        while it.valid() and type(it.key()) == str and it.key().startswith(key_prefix):
+            yield self._token_reverse_dict.remove_prefix(it.key()), it.value()
+            it.next()
 
 
 class KonlTrieWriteBatch:
-    def __init__(self, trie: KonlTrie, wb: rocksdict.WriteBatch):
+    def __init__(self, trie: KonlTrie, wb: rocksdict.WriteBatch, deferred: bool = False):
         self._cf = trie._cf
-        self._cf_handle = self._cf.get_column_family_handle(trie._name)
+        self._cf_handle = trie._cf_handle
         self._wb = wb
+        self._top_k = trie._top_k
+        self._frequencies = {}
+        self._counters = {}
+        self._deferred = deferred
+        self._deferred_tokens: typing.Set[str] = set()
+        self._deferred_deletes: typing.Set[str] = set()
 
-        iter = self._cf.iter()
+        self.__open(self._cf.iter())
 
+    def __open(self, iter: rocksdict.RdictIter):
         self._token_dict_view = KonlDictView(iter, _TOKEN_DICT)
         self._token_reverse_dict_view = KonlDictView(iter, _TOKEN_REVERSE_DICT)
-        self._token_dict_wb = KonlDictWriteBatch(wb, self._cf_handle, _TOKEN_DICT)
-        self._token_reverse_dict_wb = KonlDictWriteBatch(wb, self._cf_handle, _TOKEN_REVERSE_DICT)
+        self._token_frequency_dict_view = KonlDictView(iter, _TOKEN_FREQUENCY_DICT)
+        self._token_dict_wb = KonlDictWriteBatch(self._wb, self._cf_handle, _TOKEN_DICT, iter)
+        self._token_reverse_dict_wb = KonlDictWriteBatch(self._wb, self._cf_handle, _TOKEN_REVERSE_DICT, iter)
+        self._token_frequency_dict_wb = KonlDictWriteBatch(self._wb, self._cf_handle, _TOKEN_FREQUENCY_DICT, iter)
+        self._present: typing.Dict[str, bool] = {}
 
     def insert(self, token) -> None:
         decomposed_token = decompose_word(token)
 
-        for i in range(len(decomposed_token)):
-            s = decomposed_token[:i+1]
-
-            if len(s) >= 2:
-                s1 = s[:-1]
-                set_s1_wb = KonlSetWriteBatch(self._wb, self._cf_handle, s1)
-                set_s1_wb.add(s)
-
         self._token_dict_wb[token] = decomposed_token
         self._token_reverse_dict_wb[decomposed_token] = token
+        self._present[token] = True
 
-    def index(self, tokens: typing.Set[str]):
-        for token in tokens:
+    def index(self, tokens: typing.Iterable[str]):
+        # a deferred batch only remembers the tokens and writes the new ones in one pass when it is finalized
+        if self._deferred:
+            tokens = list(tokens)
+
+            self._deferred_tokens.update(tokens)
+            self._deferred_deletes.difference_update(tokens)
+            return
+
+        for token in self.__get_new_tokens(list(dict.fromkeys(tokens))):
             self.insert(token)
 
-    def delete(self, token) -> None:
-        if token not in self._token_dict_view:
+    def finalize(self):
+        if not self._deferred_tokens and not self._deferred_deletes:
             return
 
-        decomposed_token = decompose_word(token)
+        # the dict counts are shared by every writer, so deferred entries are written against a fresh read
+        self.__open(self._cf.iter())
+
+        for token in sorted(self._deferred_deletes):
+            self.__delete(token)
 
-        if decomposed_token not in self._token_reverse_dict_view:
+        new_tokens = self.__get_new_tokens(sorted(self._deferred_tokens))
+        decomposed_tokens = {token: decompose_word(token) for token in new_tokens}
+
+        self._token_dict_wb.update_missing(decomposed_tokens)
+        self._token_reverse_dict_wb.update_missing({decomposed_token: token
+                                                    for token, decomposed_token in decomposed_tokens.items()})
+        self._present.update(dict.fromkeys(new_tokens, True))
+        self._deferred_tokens = set()
+        self._deferred_deletes = set()
+
+    def __get_new_tokens(self, tokens: typing.List[str]) -> typing.List[str]:
+        unknown_tokens = [token for token in tokens if token not in self._present]
+
+        # one multi-get finds the tokens already in the trie, so only new tokens are written
+        for chunk in utility.batched(unknown_tokens, _MULTI_GET_SIZE):
+            keys = [self._token_dict_view.build_key_name(token) for token in chunk]
+
+            for token, value in zip(chunk, self._cf[keys]):
+                self._present[token] = value is not None
+
+        return [token for token in tokens if not self._present[token]]
+
+    def delete(self, token) -> None:
+        if self._deferred:
+            self._deferred_tokens.discard(token)
+            self._deferred_deletes.add(token)
             return
 
-        for i in range(len(decomposed_token)-1, 1, -1):
-            s = decomposed_token[:i+1]
+        self.__delete(token)
+
+    def __delete(self, token) -> None:
+        decomposed_token = decompose_word(token)
+        present = self._present.get(token)
+
+        if present is None:
+            present = token in self._token_dict_view and decomposed_token in self._token_reverse_dict_view
 
-            if len(s) >= 2:
-                s1 = s[:-1]
-                set_s1_wb = KonlSetWriteBatch(self._wb, self._cf_handle, s1)
-                set_s1_wb.remove(s)
+        if not present:
+            return
 
         del self._token_dict_wb[token]
         del self._token_reverse_dict_wb[decomposed_token]
+        self._present[token] = False
+
+        # only tokens with a frequency can be ranked by the prefix counters, so the others skip loading them
+        if token in self._frequencies or token in self._token_frequency_dict_view:
+            for i in range(len(decomposed_token)):
+                del self.__get_counter(decomposed_token[:i+1])[token]
+
+            del self._token_frequency_dict_wb[token]
+            self._frequencies.pop(token, None)
+
+    def increase_frequencies(self, frequencies: typing.Dict[str, int]) -> None:
+        for token, size in frequencies.items():
+            if size <= 0 or token not in self._token_dict_view:
+                continue
+
+            count = self.__get_frequency(token) + size
+            self._frequencies[token] = count
+            self._token_frequency_dict_wb[token] = count
+
+            decomposed_token = decompose_word(token)
+
+            for i in range(len(decomposed_token)):
+                self.__get_counter(decomposed_token[:i+1])[token] = count
+
+    def __get_frequency(self, token: str) -> int:
+        if token in self._frequencies:
+            return self._frequencies[token]
+
+        try:
+            return self._token_frequency_dict_view[token]
+        except KeyError:
+            return 0
+
+    def __get_counter(self, decomposed_prefix: str) -> KonlCounterWriteBatch:
+        if decomposed_prefix not in self._counters:
+            self._counters[decomposed_prefix] = KonlCounterWriteBatch(
+                self._wb, self._cf_handle, self._cf, build_frequency_prefix(decomposed_prefix), self._top_k)
+
+        return self._counters[decomposed_prefix]
 
 
 class KonlTrie:
-    def __init__(self, db: rocksdict.Rdict, name: str):
+    def __init__(self, db: rocksdict.Rdict, name: str, top_k: int = SUGGESTION_TOP_K,
+                 options: typing.Optional[rocksdict.Options] = None):
         self._name = build_trie_name(name)
-        self._cf = utility.create_or_get_cf(db, self._name)
-        self._token_dict = KonlDict(self._cf, _TOKEN_DICT)
-        self._token_reverse_dict = KonlDict(self._cf, _TOKEN_REVERSE_DICT)
-        self._token_frequency_dict = KonlDefaultDict(self._cf, _TOKEN_FREQUENCY_DICT, 0)
+        self._cf = utility.create_or_get_cf(db, self._name, options)
+        self._cf_handle = db.get_column_family_handle(self._name)
+        self._token_dict = KonlDict(self._cf, _TOKEN_DICT, self._cf_handle)
+        self._token_reverse_dict = KonlDict(self._cf, _TOKEN_REVERSE_DICT, self._cf_handle)
+        self._token_frequency_dict = KonlDefaultDict(self._cf, _TOKEN_FREQUENCY_DICT, 0, self._cf_handle)
+        self._top_k = top_k
 
     def close(self):
+        self._cf_handle = None
+        self._token_dict = None
+        self._token_reverse_dict = None
+        self._token_frequency_dict = None
         self._cf.close()
 
     def to_view(self) -> KonlTrieView:
         return KonlTrieView(self._cf.iter())
 
-    def to_write_batch(self, wb: rocksdict.WriteBatch) -> KonlTrieWriteBatch:
-        return KonlTrieWriteBatch(self, wb)
+    def to_write_batch(self, wb: rocksdict.WriteBatch, deferred: bool = False) -> KonlTrieWriteBatch:
+        return KonlTrieWriteBatch(self, wb, deferred)
 
     def insert(self, token) -> None:
         if token in self._token_dict:
@@ -142,14 +229,6 @@ class KonlTrie:
 
         decomposed_token = decompose_word(token)
 
-        for i in range(len(decomposed_token)):
-            s = decomposed_token[:i+1]
-
-            if len(s) >= 2:
-                s1 = s[:-1]
-                set_s1 = KonlSet(self._cf, s1)
-                set_s1.add(s)
-
         self._token_dict[token] = decomposed_token
         self._token_reverse_dict[decomposed_token] = token
 
@@ -166,14 +245,6 @@ class KonlTrie:
         if decomposed_token not in self._token_reverse_dict:
             return
 
-        for i in range(len(decomposed_token)-1, 1, -1):
-            s = decomposed_token[:i+1]
-
-            if len(s) >= 2:
-                s1 = s[:-1]
-                set_s1 = KonlSet(self._cf, s1)
-                set_s1.remove(s)
-
         del self._token_dict[token]
         del self._token_reverse_dict[decomposed_token]
 
@@ -181,11 +252,14 @@ class KonlTrie:
         del self._token_frequency_dict[token]
 
     def increase_frequency(self, token: str, size: int):
-        if token not in self._token_dict or size <= 0:
-            return
+        self.increase_frequencies({token: size})
 
-        self._token_frequency_dict[token] += size
-        self.__update_counter(token)
+    def increase_frequencies(self, frequencies: typing.Dict[str, int]):
+        wb = rocksdict.WriteBatch()
+
+        self.to_write_batch(wb).increase_frequencies(frequencies)
+
+        self._cf.write(wb)
 
     def decrease_frequency(self, token: str, size: int):
         if token not in self._token_dict or size <= 0:
@@ -197,31 +271,48 @@ class KonlTrie:
     def search(self, prefix: str) -> typing.List[str]:
         return self.to_view().search(prefix)
 
+    def suggest(self, prefix: str, k: int = SUGGESTION_TOP_K,
+                order: SuggestionOrder = SuggestionOrder.FREQUENCY) -> typing.List[str]:
+        if k <= 0:
+            return []
+
+        decomposed_prefix = decompose_word(prefix)
+        view = self.to_view()
+
+        if order == SuggestionOrder.LEXICAL:
+            return [token for _, token in itertools.islice(view.items(decomposed_prefix), k)]
+
+        # the counters only rank the top k of every prefix, so a deeper request has to rank the whole subtree
+        if k > self._top_k:
+            tokens = [token for _, token in view.items(decomposed_prefix)]
+            return heapq.nsmallest(k, tokens, key=lambda token: -self._token_frequency_dict[token])
+
+        result = [token for token, count in itertools.islice(self.__get_counter(decomposed_prefix).items(), k)
+                  if count > 0]
+
+        if len(result) < k:
+            ranked_tokens = set(result)
+            result.extend(itertools.islice((token for _, token in view.items(decomposed_prefix)
+                                            if token not in ranked_tokens), k - len(result)))
+
+        return result
+
     def search_by_frequency(self, prefix: str) -> typing.List[SearchFrequencyResponse]:
         return [SearchFrequencyResponse(token=counter[0], count=counter[1]) for counter
-                in KonlCounter(self._cf, self.__build_frequency_prefix(prefix), 5).items()]
+                in self.__get_counter(decompose_word(prefix)).items()]
 
-    def __build_frequency_prefix(self, s: str):
-        return f'freq:{s}'
+    def __get_counter(self, decomposed_prefix: str) -> KonlCounter:
+        return KonlCounter(self._cf, build_frequency_prefix(decomposed_prefix), self._top_k)
 
     def __update_counter(self, token: str):
         decomposed_token = decompose_word(token)
+        count = self._token_frequency_dict[token]
 
         for i in range(len(decomposed_token)):
-            s = decomposed_token[:i+1]
-
-            if len(s) >= 2:
-                s1 = s[:-1]
-                counter_s1 = KonlCounter(self._cf, self.__build_frequency_prefix(s1), 5)
-                counter_s1[token] = self._token_frequency_dict[token]
+            self.__get_counter(decomposed_token[:i+1])[token] = count
 
     def __delete_counter(self, token: str):
         decomposed_token = decompose_word(token)
 
         for i in range(len(decomposed_token)):
-            s = decomposed_token[:i+1]
-
-            if len(s) >= 2:
-                s1 = s[:-1]
-                counter_s1 = KonlCounter(self._cf, self.__build_frequency_prefix(s1), 5)
-                counter_s1.destroy()
+            del self.__get_counter(decomposed_token[:i+1])[token]
@@ -1,3 +1,4 @@
+import heapq
 import itertools
 import typing
 
@@ -6,8 +7,11 @@ import rocksdict
 T = typing.TypeVar("T")
 
 
-def create_cf(db: rocksdict.Rdict, name: str) -> rocksdict.Rdict:
-    return db.create_column_family(name)
+def create_cf(db: rocksdict.Rdict, name: str, options: typing.Optional[rocksdict.Options] = None) -> rocksdict.Rdict:
+    if options is None:
+        return db.create_column_family(name)
+
+    return db.create_column_family(name, options)
 
 
 def get_cf(db: rocksdict.Rdict, name: str) -> rocksdict.Rdict:
@@ -15,12 +19,77 @@ def get_cf(db: rocksdict.Rdict, name: str) -> rocksdict.Rdict:
 
 
 # noinspection PyBroadException
-def create_or_get_cf(db: rocksdict.Rdict, name: str) -> rocksdict.Rdict:
+def create_or_get_cf(db: rocksdict.Rdict, name: str, options: typing.Optional[rocksdict.Options] = None) \
+        -> rocksdict.Rdict:
     try:
-        return create_cf(db, name)
+        return create_cf(db, name, options)
     except Exception:
         return get_cf(db, name)
 
 
+def get_value(it: rocksdict.RdictIter, key, default=None):
+    it.seek(key)
+
+    if it.valid() and it.key() == key:
+        return it.value()
+
+    return default
+
+
+def batched(iterable: typing.Iterable[T], size: int) -> typing.Generator[typing.List[T], None, None]:
+    it = iter(iterable)
+
+    while batch := list(itertools.islice(it, size)):
+        yield batch
+
+
+def unique_sorted(iterable: typing.Iterable[T]) -> typing.Generator[T, None, None]:
+    previous = None
+
+    for x in iterable:
+        if x != previous:
+            yield x
+            previous = x
+
+
+def intersect_sorted(iterable1: typing.Iterable[T], iterable2: typing.Iterable[T]) -> typing.Generator[T, None, None]:
+    it1 = iter(iterable1)
+    it2 = iter(iterable2)
+
+    x = next(it1, None)
+    y = next(it2, None)
+
+    while x is not None and y is not None:
+        if x == y:
+            yield x
+            x = next(it1, None)
+            y = next(it2, None)
+        elif x < y:
+            x = next(it1, None)
+        else:
+            y = next(it2, None)
+
+
 def is_sorted(list: typing.List[T]) -> bool:
     return all(x <= y for x, y in itertools.pairwise(list))
+
+
+def min_span(lists: typing.List[typing.List[int]]) -> int:
+    if not lists:
+        return 0
+
+    heap = [(values[0], i, 0) for i, values in enumerate(lists)]
+    heapq.heapify(heap)
+
+    high = max(values[0] for values in lists)
+    span = high - heap[0][0]
+
+    while True:
+        low, i, j = heapq.heappop(heap)
+        span = min(span, high - low)
+
+        if j + 1 == len(lists[i]):
+            return span
+
+        high = max(high, lists[i][j + 1])
+        heapq.heappush(heap, (lists[i][j + 1], i, j + 1))
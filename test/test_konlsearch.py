@@ -1,18 +1,29 @@
 # flake8: noqa: E501
 
 from konlsearch.search import KonlSearch
-from konlsearch.index import (TokenSearchMode,
+from konlsearch.profile import StorageProfile
+from konlsearch.format import StorageFormat
+from konlsearch.migrate import convert_legacy_postings, migrate_index
+from konlsearch.index import (KonlIndex,
+                              TokenSearchMode,
                               SearchGetRequest,
                               ComplexSearchGetRequest,
                               SearchMode,
                               IndexingStatusCode,
-                              GetStatusCode)
+                              GetStatusCode,
+                              SuggestionOrder,
+                              query_morphs)
 from konlsearch.set import KonlSet, KonlSetWriteBatch
+from konlsearch import posting
+from konlsearch.posting import KonlPostingListView, KonlPostingListWriteBatch, BLOCK_SIZE
 from konlsearch.dict import KonlDict, KonlDefaultDict, KonlDictWriteBatch
-from konlsearch.log import KonlSearchLog, SearchLogRequest
-from konlsearch.counter import KonlCounter
+from konlsearch.log import KonlSearchLog, KonlSearchLogBuffer, SearchLogBufferOptions, SearchLogRequest, SearchLogResponse
+from konlsearch.counter import KonlCounter, KonlCounterWriteBatch
+from konlsearch.scheduler import KonlScheduler
 
+import concurrent.futures
 import datetime
+import threading
 import pytest
 import time
 import rocksdict
@@ -229,6 +240,28 @@ def test_search_mode_phrase(index):
     assert document_ids == []
 
 
+def test_search_near(index):
+    assert index.search_near(["마법소녀", "악"], 2) == [97]
+    assert index.search_near(["마법소녀", "악"], 1) == []
+    assert index.search_near(["마법", "특별"], 2) == [9]
+
+    index.delete(97)
+
+    assert index.search_near(["마법소녀", "악"], 2) == []
+
+
+def test_search_ranked(index):
+    tokens = ["죽", "한심", "사랑"]
+
+    ranked = index.search_ranked(tokens, k=100)
+    scores = [r.score for r in ranked]
+
+    assert sorted(r.id for r in ranked) == index.search(tokens, TokenSearchMode.OR)
+    assert ranked[0].id == 107 and scores == sorted(scores, reverse=True)
+    assert all(index.search_ranked(tokens, k=k) == ranked[:k] for k in range(1, 6))
+    assert index.search_ranked(["없는단어"]) == []
+
+
 def test_search_mode_complex(index):
     request = ComplexSearchGetRequest(
         condition1=SearchGetRequest(
@@ -254,6 +287,140 @@ def test_search_mode_complex(index):
     assert document_ids == [1, 3, 9, 10, 18, 81]
 
 
+def test_search_pagination(index):
+    def pages(search):
+        result = []
+        after_id = None
+
+        while page := search(after_id):
+            result.extend(page)
+            after_id = page[-1]
+
+        return result
+
+    request = ComplexSearchGetRequest(
+        condition1=SearchGetRequest(tokens=["너무", "사랑"], mode=TokenSearchMode.OR),
+        condition2=SearchGetRequest(tokens=["마법", "특별"], mode=TokenSearchMode.PHRASE),
+        mode=SearchMode.OR
+    )
+
+    for tokens, mode in [(["너무", "사랑", "소녀"], TokenSearchMode.OR), (["은", "는"], TokenSearchMode.AND),
+                         (["은", "다"], TokenSearchMode.PHRASE)]:
+        assert pages(lambda after_id: index.search(tokens, mode, limit=2, after_id=after_id)) == index.search(tokens, mode)
+
+    assert pages(lambda after_id: index.search_complex(request, limit=2, after_id=after_id)) == index.search_complex(request)
+    assert list(index.iter_search_complex(request, after_id=40)) == [d for d in index.search_complex(request) if d > 40]
+
+    responses = index.get_all(limit=5, after_id=130)
+
+    assert [r.result.id for r in responses] == [131, 132]
+    assert [r.result.id for r in index.get_range(10, 20, limit=3)] == [10, 11, 12]
+
+
+def test_search_text(index):
+    assert index.search_text("사랑을 한다", TokenSearchMode.OR) == index.search(["사랑", "을", "한다", "사랑을"], TokenSearchMode.OR)
+    assert index.search_text("마법은 특별", TokenSearchMode.PHRASE) == index.search(["마법", "특별"], TokenSearchMode.PHRASE)
+    assert index.search_text("!!", TokenSearchMode.AND) == []
+
+    hits = query_morphs.cache_info().hits
+    index.search_text("마법은 특별", TokenSearchMode.PHRASE)
+
+    assert query_morphs.cache_info().hits > hits
+
+    size = query_morphs.cache_info().currsize
+    index.index("캐시에 남지 않는 새 문서")
+
+    assert query_morphs.cache_info().currsize == size
+
+
+def test_count(index):
+    for tokens in [["사랑"], ["사랑", "사랑"], ["너무", "사랑", "소녀"], ["은", "는"], ["은", "없는말"], ["없는말"], []]:
+        for mode in [TokenSearchMode.AND, TokenSearchMode.OR, TokenSearchMode.PHRASE]:
+            assert index.count(tokens, mode) == len(index.search(tokens, mode))
+
+    request = ComplexSearchGetRequest(
+        condition1=SearchGetRequest(tokens=["너무", "사랑"], mode=TokenSearchMode.OR),
+        condition2=SearchGetRequest(tokens=["은", "다"], mode=TokenSearchMode.AND),
+        mode=SearchMode.OR
+    )
+
+    assert index.count_complex(request) == len(index.search_complex(request))
+
+    request.mode = SearchMode.AND
+
+    assert index.count_complex(request) == len(index.search_complex(request))
+
+    log = index._inverted_index._log
+    last_seq_id = log.get_last_seq_id()
+
+    assert index.count(["마법", "특별"], TokenSearchMode.PHRASE) > 0
+    assert index.count_complex(ComplexSearchGetRequest(SearchGetRequest(["마법", "특별"], TokenSearchMode.PHRASE),
+                                                       request, SearchMode.OR)) > 0
+    assert log.get_last_seq_id() == last_seq_id
+
+
+def test_posting_cache(index):
+    result = index.search(["사랑"], TokenSearchMode.AND)
+    stats = index.get_cache_stats()
+
+    assert index.search(["사랑"], TokenSearchMode.AND) == result
+    assert index.get_cache_stats().hits == stats.hits + 1 and stats.entries == 1
+
+    r1 = index.index("사랑의 캐시")
+
+    assert index.search(["사랑"], TokenSearchMode.AND) == result + [r1.document_id]
+
+    index_wb = index.to_write_batch()
+    r2 = index_wb.index("캐시 사랑")
+    index_wb.commit()
+
+    assert index.search(["사랑"], TokenSearchMode.AND) == result + [r1.document_id, r2.document_id]
+
+    index.delete(r1.document_id)
+
+    assert index.search(["사랑"], TokenSearchMode.AND) == result + [r2.document_id]
+
+
+def test_stored_cardinality(index):
+    cf_handle = index._cf_handle
+    s = KonlSet(index._cf, "count")
+
+    assert s.is_empty() and len(s) == 0
+
+    s.update({"1", "2", "3"})
+    s.add("1")
+    s.remove("4")
+
+    assert s.get_stored_len() == 3 and not s.is_empty()
+
+    wb = rocksdict.WriteBatch()
+    s_wb = KonlSetWriteBatch(wb, cf_handle, "count", index._cf.iter())
+    s_wb.add("3")
+    s_wb.add("4")
+    s_wb.remove("1")
+    index.commit(wb)
+
+    assert s.get_stored_len() == 3 and sorted(s.items()) == ["2", "3", "4"]
+
+    wb = rocksdict.WriteBatch()
+    KonlSetWriteBatch(wb, cf_handle, "count").add("5")
+    index.commit(wb)
+
+    assert s.get_stored_len() is None and len(s) == 4
+
+    d = KonlDict(index._cf, "count")
+    d["a"] = "1"
+    d["a"] = "2"
+    d["b"] = "3"
+    del d["a"]
+
+    assert d.get_stored_len() == 1 and len(d.to_view()) == 1
+
+    p = KonlPostingListView(index._inverted_index._cf.iter(), "사랑")
+
+    assert p._len_prefix in index._inverted_index._cf and len(p) == len(p.to_array())
+
+
 def test_index_writebatch1(konl_search):
     index_name = "title"
     index = konl_search.index(index_name)
@@ -271,6 +438,61 @@ def test_index_writebatch1(konl_search):
     index.close()
 
 
+def test_index_many(konl_search):
+    index = konl_search.index("title")
+
+    r = index.index_many(titles + [titles[9]], workers=2, batch_size=50)
+
+    codes = [result.status_code for result in r]
+    document_ids = [result.document_id for result in r]
+
+    assert codes[:-1] == [IndexingStatusCode.SUCCESS] * len(titles) and codes[-1] == IndexingStatusCode.CONFLICT
+    assert document_ids == list(range(1, len(titles) + 1)) + [10]
+    assert len(index) == 132 and index.search(["마법", "특별"], TokenSearchMode.AND) == [9]
+
+    r = index.index_many(["기동전사 건담", titles[0]], workers=1)
+
+    assert [result.document_id for result in r] == [133, 1]
+
+    index.close()
+
+
+def test_index_build(konl_search, tmp_path):
+    index = konl_search.index("title")
+
+    r = index.build(titles[:100], workers=1, batch_size=30, path=str(tmp_path))
+
+    assert [result.document_id for result in r] == list(range(1, 101))
+
+    r = index.build(titles[100:] + [titles[9]], workers=1)
+
+    assert [result.document_id for result in r] == list(range(101, 133)) + [10]
+    assert r[-1].status_code == IndexingStatusCode.CONFLICT
+    assert len(index) == 132 and index.get(10).result.document == titles[9]
+    assert index.search(["같은", "비스크"], TokenSearchMode.OR) == [10, 18, 81]
+    assert index.search_suggestions("특") == ["특급", "특별", "특별해야"]
+    assert list(tmp_path.iterdir()) == []
+
+    trie = index._inverted_index._trie
+
+    assert len(trie._token_dict) == sum(1 for _ in trie._token_dict.items())
+
+    index.close()
+
+
+def test_index_build_batches(konl_search):
+    index = konl_search.index("title")
+
+    r = index.build(titles + [titles[0], titles[75]], workers=1, batch_size=25)
+
+    assert [result.document_id for result in r] == list(range(1, len(titles) + 1)) + [1, 76]
+    assert [result.status_code for result in r[-2:]] == [IndexingStatusCode.CONFLICT] * 2
+    assert len(index) == len(titles) and index.get_total_length() > 0
+    assert index.search(["같은", "비스크"], TokenSearchMode.OR) == [10, 18, 81]
+
+    index.close()
+
+
 def test_index_writebatch2(index):
     index_wb = index.to_write_batch()
 
@@ -440,6 +662,65 @@ def test_set_writebatch(index):
     assert len(s) == 2
 
 
+def test_posting_list(index):
+    cf = index._inverted_index._cf
+    cf_handle = index._inverted_index._cf_handle
+
+    wb1 = rocksdict.WriteBatch()
+    p_wb = KonlPostingListWriteBatch(wb1, cf_handle, cf.iter(), "test")
+
+    p_wb.update(range(10, 10 + BLOCK_SIZE * 3, 2))
+    p_wb.update([5, 11, 5])
+
+    cf.write(wb1)
+
+    expected = sorted({5, 11} | set(range(10, 10 + BLOCK_SIZE * 3, 2)))
+    p = KonlPostingListView(cf.iter(), "test")
+
+    assert list(p.items()) == expected and len(p) == len(expected)
+    assert all(block_id == document_ids for block_id, document_ids
+               in [(block_id, next(p.items(block_id))) for block_id, _ in p.blocks()])
+    assert 11 in p and 13 not in p and 4 not in p
+    assert list(p.items(100)) == [d for d in expected if d >= 100]
+
+    wb2 = rocksdict.WriteBatch()
+    p_wb = KonlPostingListWriteBatch(wb2, cf_handle, cf.iter(), "test")
+
+    for document_id in expected[:-1]:
+        p_wb.remove(document_id)
+
+    assert not p_wb.is_empty()
+
+    p_wb.remove(expected[-1])
+
+    assert p_wb.is_empty()
+
+    cf.write(wb2)
+
+    p = KonlPostingListView(cf.iter(), "test")
+
+    assert list(p.items()) == [] and p.is_empty() and len(p) == 0
+
+
+def test_posting_intersect(index):
+    cf = index._inverted_index._cf
+
+    wb = rocksdict.WriteBatch()
+    KonlPostingListWriteBatch(wb, index._inverted_index._cf_handle, cf.iter(), "test").update(range(0, 3000, 3))
+    cf.write(wb)
+
+    p = KonlPostingListView(cf.iter(), "test")
+    small = posting.new_array([1, 3, 299, 300, 2997, 5000])
+    large = p.to_array()
+
+    assert posting.intersect(small, large).tolist() == [3, 300, 2997]
+    assert posting.intersect(large, posting.new_array(range(0, 300, 2))).tolist() == list(range(0, 300, 6))
+    assert p.intersect(small).tolist() == [3, 300, 2997]
+    assert posting.union([small, posting.new_array([2, 3])]).tolist() == [1, 2, 3, 299, 300, 2997, 5000]
+    assert posting.union([small, large, posting.new_array([0, 2])]).tolist() == sorted(set(small) | set(large) | {2})
+    assert posting.count_union([small, large]) == len(set(small) | set(large))
+
+
 def test_dict(index):
     d = KonlDict(index._cf, "test")
 
@@ -559,6 +840,101 @@ def test_trie_suggestion(index):
 
     assert suggestions == ["특급", "특별", "특별해야"]
 
+    trie = index._inverted_index._trie
+    tokens = [token for token, decomposed_token in trie._token_dict.items() if decomposed_token.startswith("ㅌ")]
+
+    assert index.search_suggestions("ㅌ") == sorted(tokens)
+    assert index.search_suggestions("") == sorted(token for token, _ in trie._token_dict.items())
+
+    index.delete(9)
+
+    assert index.search_suggestions(prefix) == ["특급"]
+
+
+def test_index_single_batch(index):
+    trie = index._inverted_index._trie
+    size = len(index)
+
+    r = index.index("새로운 마법소녀 이야기")
+
+    assert len(index) == size + 1 and "이야기" in trie._token_dict
+    assert len(trie._token_dict) == sum(1 for _ in trie._token_dict.items())
+    assert index.index("새로운 마법소녀 이야기").status_code == IndexingStatusCode.CONFLICT
+
+    index_wb = index.to_write_batch()
+    index_wb.delete(9)
+    index_wb.index("특별해야 하는 이유")
+    index_wb.commit()
+
+    assert index.search_suggestions("특") == ["특급", "특별", "특별해야"]
+    assert r.document_id in index.search(["이야기"], TokenSearchMode.OR)
+
+
+def test_deferred_trie(index):
+    trie = index._inverted_index._trie
+    size = len(trie._token_dict)
+
+    index_wb = index.to_write_batch(deferred_trie=True)
+    index_wb.index("기동전사 건담")
+    index_wb.delete(9)
+    index_wb.index("특별해야 하는 이유")
+
+    assert "건담" not in index.search_suggestions("건")
+
+    index_wb.commit()
+
+    assert "건담" in index.search_suggestions("건")
+    assert index.search_suggestions("특") == ["특급", "특별", "특별해야"]
+    assert len(trie._token_dict) == sum(1 for _ in trie._token_dict.items()) > size
+
+
+def test_concurrent_index(index):
+    trie = index._inverted_index._trie
+    size = len(index)
+    total_length = index.get_total_length()
+    documents = [f"{title} 동시 색인 {i}" for i, title in enumerate(titles[:40])]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(index.index, documents + documents[:10]))
+
+    document_ids = [r.document_id for r in results if r.status_code == IndexingStatusCode.SUCCESS]
+
+    assert len(set(document_ids)) == len(document_ids) == 40 and len(index) == size + 40
+    assert index.get_total_length() == total_length + sum(index.get_length(i) for i in document_ids)
+    assert sorted(document_ids) == index.search(["동시"], TokenSearchMode.OR)
+    assert len(trie._token_dict) == sum(1 for _ in trie._token_dict.items())
+
+
+def test_snapshot(index):
+    size = len(index)
+    documents = index.get_all()
+    phrase = index.search(["마법", "소녀"], TokenSearchMode.PHRASE)
+    magic = index.search(["마법"], TokenSearchMode.OR)
+
+    snapshot = index.snapshot()
+
+    r = index.index("새로운 마법 소녀 스냅샷")
+    index.delete(9)
+
+    assert len(snapshot) == size and len(index) == size
+    assert snapshot.get(9).status_code == GetStatusCode.SUCCESS
+    assert snapshot.get(r.document_id).status_code == GetStatusCode.FAILURE
+    assert snapshot.search(["마법", "소녀"], TokenSearchMode.PHRASE) == phrase
+    assert r.document_id in index.search(["마법", "소녀"], TokenSearchMode.PHRASE)
+    assert snapshot.search(["스냅샷"], TokenSearchMode.OR) == [] and snapshot.search_suggestions("스냅") == []
+    assert snapshot.get_multi([9, r.document_id]) == [documents[8]]
+
+    # documents read in between do not disturb a running scan
+    assert [snapshot.get(response.result.id) for response in snapshot.iter_all()] == documents
+    assert snapshot.get_range(8, 11) == documents[7:10]
+
+    request = ComplexSearchGetRequest(SearchGetRequest(["마법"], TokenSearchMode.OR),
+                                      SearchGetRequest(["스냅샷"], TokenSearchMode.OR), SearchMode.OR)
+
+    assert snapshot.search_complex(request) == magic and snapshot.count_complex(request) == len(magic)
+
+    snapshot.close()
+
 
 def test_get_all_indexes(konl_search, index):
     indexes = sorted(konl_search.get_all_indexes())
@@ -585,13 +961,115 @@ def test_search_log(index):
 
     assert tokens == sorted([x.token for x in r])
 
-    time.sleep(1)
+    seq_ids = [log.generate_seq_id() for _ in range(100000)]
+
+    assert seq_ids == sorted(set(seq_ids)) and seq_id1 < seq_ids[0]
+    assert all(len(seq_id) == len(seq_id1) for seq_id in seq_ids)
+
+    future_seq_id = KonlSearchLog.build_seq_id(time.time_ns() // 1000000 + 60000, 3)
+    KonlSearchLog(index._cf, index._cf_handle).write([SearchLogResponse(seq_id=future_seq_id, size=1, token="미래")])
+
+    assert KonlSearchLog.parse_seq_id(future_seq_id)[1:] == (3, 0)
+    assert KonlSearchLog(index._cf).generate_seq_id() > future_seq_id
+
+
+def test_search_log_concurrent_aggregation(index):
+    trie = index._inverted_index._trie
+    log = index._inverted_index._log
+    token = sorted(index.get_tokens(10))[0]
+    frequency = trie._token_frequency_dict[token]
+
+    def append():
+        for _ in range(2000):
+            log.append(token, 1)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(append) for _ in range(4)]
+
+        while not all(future.done() for future in futures):
+            index.aggregate_frequency()
+
+    index.aggregate_frequency()
+
+    assert trie._token_frequency_dict[token] == frequency + 8000
+
+
+def test_aggregate_frequency_commit_lock(index):
+    trie = index._inverted_index._trie
+    token = sorted(index.get_tokens(10))[0]
+    frequency = trie._token_frequency_dict[token]
+
+    index._inverted_index._log.append(token, 1)
 
-    seq_id2 = log.generate_seq_id()
-    seq_id3 = log.generate_seq_id()
+    # frequencies wait for the writers' commit lock, so a concurrent delete can never be undone by them
+    with index._commit_lock:
+        thread = threading.Thread(target=index.aggregate_frequency)
+        thread.start()
+        thread.join(0.2)
 
-    assert seq_id1.split(":")[1] == seq_id2.split(":")[1]
-    assert seq_id3.split(":")[1] == '0002'
+        assert thread.is_alive() and trie._token_frequency_dict[token] == frequency
+
+    thread.join()
+
+    assert trie._token_frequency_dict[token] == frequency + 1
+
+
+def test_search_log_upgrade(tmp_path):
+    path = str(tmp_path / "legacy-db")
+
+    ks = KonlSearch(path)
+    index = ks.index("legacy")
+    index.index("access denied")
+
+    cf = index._inverted_index._cf
+    ts = int(time.time()) - 10
+
+    # entries and the offset as they were written before the hybrid logical clock
+    for count, size in [(1, 5), (2, 1), (3, 2)]:
+        cf[f'access:{ts}:{count:04}:denied'] = size
+
+    cf["log:offset"] = f'{ts}:0002'
+
+    index.close()
+    ks.close()
+
+    ks = KonlSearch(path)
+    index = ks.index("legacy")
+    trie = index._inverted_index._trie
+
+    assert index.search(["access"], TokenSearchMode.OR) == [1]
+
+    index.aggregate_frequency()
+
+    assert trie._token_frequency_dict["denied"] == 3
+    assert not any(type(key) == str and key.startswith(f'access:{ts}') for key in index._inverted_index._cf.keys())
+
+    index.close()
+    ks.close()
+    ks.destroy()
+
+
+def test_scheduler_task_failure(caplog):
+    runs = []
+    done = threading.Event()
+
+    def task():
+        runs.append(len(runs))
+
+        if len(runs) == 1:
+            raise RuntimeError
+
+        done.set()
+
+    scheduler = KonlScheduler(0.01, task, "failing")
+    scheduler.start()
+
+    assert done.wait(5)
+    assert scheduler.is_running()
+
+    scheduler.stop()
+
+    assert "scheduled task failing failed" in caplog.text
 
 
 def test_counter(index):
@@ -619,6 +1097,43 @@ def test_counter(index):
     assert list(counter.items()) == [('c', 1000), ('b', 100), ('a', 10)]
 
 
+def test_counter_writebatch(index):
+    counter = KonlCounter(index._cf, "test", 3)
+    counter.increase("a", 10)
+    counter.increase("b", 100)
+
+    wb = rocksdict.WriteBatch()
+    counter_wb = KonlCounterWriteBatch(wb, index._cf_handle, index._cf, "test", 3)
+    counter_wb.increase("a", 5)
+    counter_wb.increase("c", 1)
+    del counter_wb["b"]
+    index._cf.write(wb)
+
+    assert list(counter.items()) == [("a", 15), ("c", 1)] and len(counter) == 2
+    assert len(counter._sorted_set) == 2 and len(counter._dict) == 2
+    assert counter._sorted_set.get_stored_len() == 2 and counter._dict.get_stored_len() == 2
+
+    counter.destroy()
+
+
+def test_counter_eviction(index):
+    counter = KonlCounter(index._cf, "test", 2)
+
+    for i in range(10):
+        counter["k" + str(i)] = i
+
+    assert list(counter.items()) == [("k9", 9), ("k8", 8)]
+    assert len(KonlCounter(index._cf, "test", 2)) == 2
+
+    counter.decrease("k8", 8)
+
+    assert "k8" not in counter and len(counter) == 1
+
+    counter.destroy()
+
+    assert len(counter) == 0 and list(counter.items()) == []
+
+
 def test_search_by_frequency(index):
     r1 = index.search(["같은", "비스크"], TokenSearchMode.OR)
     r2 = index.search(["특별", "마법소녀"], TokenSearchMode.OR)
@@ -638,3 +1153,284 @@ def test_search_by_frequency(index):
     counts = [r.count for r in r10]
 
     assert tokens == ["마법소녀", "마법", "모래"] and counts == [6, 1, 1]
+
+
+def test_aggregate_frequency_chunks(index):
+    inverted_index = index._inverted_index
+
+    for _ in range(5):
+        index.search(["마법소녀", "마법"], TokenSearchMode.OR)
+
+    inverted_index.aggregate_frequency(chunk_size=3)
+    inverted_index.aggregate_frequency(chunk_size=3)
+
+    responses = inverted_index._trie.search_by_frequency("마법")
+
+    assert [(r.token, r.count) for r in responses] == [("마법", 5), ("마법소녀", 5)]
+
+    index.search(["마법"], TokenSearchMode.OR)
+    index.start_frequency_aggregation(0.01)
+
+    deadline = time.time() + 5
+
+    while inverted_index._trie.search_by_frequency("마법")[0].count != 6 and time.time() < deadline:
+        time.sleep(0.01)
+
+    index.stop_frequency_aggregation()
+
+    assert inverted_index._trie.search_by_frequency("마법")[0].count == 6
+
+
+def test_search_log_buffer(index):
+    log = KonlSearchLog(index._cf, index._cf_handle)
+    log_buffer = KonlSearchLogBuffer(log, SearchLogBufferOptions(flush_size=1000, flush_interval=60, max_size=3))
+
+    for token in ["가", "나", "다", "라"]:
+        log_buffer.append(token, 1)
+
+    assert len(log_buffer) == 3 and log_buffer.get_dropped_count() == 1 and log.get_first_seq_id() is None
+
+    log_buffer.close()
+
+    assert [r.token for r in log.get_range_seq_id(log.get_first_seq_id(), log.generate_seq_id())] == ["가", "나", "다"]
+
+    sampled_buffer = KonlSearchLogBuffer(log, SearchLogBufferOptions(flush_interval=60, sample_rate=0.5))
+
+    for _ in range(100):
+        sampled_buffer.append("마", 1)
+
+    assert all(entry.size == 2 for entry in sampled_buffer._entries)
+
+    sampled_buffer.close()
+    log.close()
+
+
+def test_search_log_buffer_aggregation(konl_search):
+    index = konl_search.index("buffered", log_buffer_options=SearchLogBufferOptions(flush_interval=60))
+    index.index("마법소녀 마법")
+
+    assert index._inverted_index._log_buffer is not None
+
+    index.search(["마법"], TokenSearchMode.OR)
+    index.search(["마법"], TokenSearchMode.OR)
+    index.aggregate_frequency()
+
+    assert index._inverted_index._trie.search_by_frequency("마법")[0].count == 2
+
+    index.close()
+
+
+def test_suggest(index):
+    for _ in range(3):
+        index.search(["마법소녀"], TokenSearchMode.OR)
+
+    index.search(["마법"], TokenSearchMode.OR)
+    index._inverted_index.aggregate_frequency()
+
+    assert index.suggest("ㅁ", 2) == ["마법소녀", "마법"]
+    assert index.suggest("마법", 3) == ["마법소녀", "마법", "마법소녀와"]
+    assert index.suggest("마법", 20)[:3] == index.suggest("마법", 3)
+    assert index.suggest("특", 2, SuggestionOrder.LEXICAL) == ["특급", "특별"]
+    assert index.suggest("특", 0) == []
+
+
+def test_suggestion_top_k(konl_search):
+    index = konl_search.index("top_k", suggestion_top_k=2)
+
+    for title in titles:
+        index.index(title)
+
+    for token in ["마법소녀", "마법", "마법소녀와"]:
+        index.search([token], TokenSearchMode.OR)
+
+    index.aggregate_frequency()
+
+    assert [r.token for r in index._inverted_index._trie.search_by_frequency("마법")] == ["마법", "마법소녀"]
+    assert index.suggest("마법", 2) == ["마법", "마법소녀"]
+
+    index.close()
+
+
+def test_suggest_after_batch_delete(index):
+    r = index.index("고양이 이야기")
+    index.search(["고양이"], TokenSearchMode.OR)
+    index.aggregate_frequency()
+
+    assert index.suggest("고", 1) == ["고양이"]
+
+    index_wb = index.to_write_batch()
+    index_wb.delete(r.document_id)
+    index_wb.commit()
+
+    assert "고양이" not in index.suggest("고") and "고양이" not in index.search_suggestions("고")
+    assert "고양이" not in index._inverted_index._trie._token_frequency_dict
+
+
+def test_storage_profile(tmp_path):
+    path = str(tmp_path / "profile-db")
+
+    ks = KonlSearch(path, profile=StorageProfile.LOW_MEMORY)
+    index = ks.index("title", StorageFormat.V2)
+
+    for title in titles:
+        index.index(title)
+
+    expected = index.search(["마법"], TokenSearchMode.OR)
+
+    assert len(expected) > 0
+
+    built = ks.index("built", StorageFormat.V2)
+    built.build(titles, workers=1, batch_size=50)
+
+    assert built.search(["마법"], TokenSearchMode.OR) == expected
+    assert built.get(10).result.document == titles[9]
+
+    built.close()
+    index.close()
+    ks.close()
+
+    ks = KonlSearch(path, profile=StorageProfile.SERVING)
+    index = ks.index("title")
+
+    assert index.search(["마법"], TokenSearchMode.OR) == expected
+    assert index.get(10).result.document == titles[9]
+    assert ks.get_all_indexes() == ["built", "title"]
+
+    index.close()
+    ks.close()
+    ks.destroy()
+
+
+def test_storage_profile_shared_cache(tmp_path, monkeypatch):
+    caches = []
+    cache = rocksdict.Cache
+
+    monkeypatch.setattr(rocksdict, "Cache", lambda size: caches.append(size) or cache(size))
+
+    ks = KonlSearch(str(tmp_path / "cache-db"), profile=StorageProfile.SERVING)
+    ks.index("title", StorageFormat.V2).close()
+
+    assert len(caches) == 1
+
+    ks.close()
+    ks.destroy()
+
+
+def test_storage_format_v2(konl_search):
+    index = konl_search.index("v2", StorageFormat.V2)
+
+    for title in titles:
+        index.index(title)
+
+    assert index.get_storage_format() == StorageFormat.V2
+    assert index.get(10).result.document == titles[9]
+    assert [r.result.id for r in index.get_range(3, 6)] == [3, 4, 5]
+    assert index.get_tokens(10) == set(index.tokenize_with_frequency(titles[9]))
+    assert index.get_length(10) == sum(index.tokenize_with_frequency(titles[9]).values())
+    assert index.search(["마법소녀"], TokenSearchMode.OR) == [49, 97]
+    assert index.search(["없는단어"], TokenSearchMode.OR) == []
+
+    terms = index._inverted_index.get_term_dictionary()
+    term_id = terms.get_ids(["마법소녀"])["마법소녀"]
+
+    assert terms.get_tokens([term_id]) == {term_id: "마법소녀"}
+
+    created = terms.get_or_create_ids(token for token in ["새단어", "마법소녀", "새단어"])
+
+    assert created["마법소녀"] == term_id and terms.get_ids(["새단어"]) == {"새단어": created["새단어"]}
+    assert len(list(index._document_cf.keys())) == len(titles)
+    assert not any(type(key) == bytes and key.startswith(b'd') for key in index._cf.keys())
+    assert not any(type(key) == str and key.startswith("마법소녀:") for key in index._inverted_index._cf.keys())
+
+    index.delete(10)
+
+    assert index.get(10).status_code == GetStatusCode.FAILURE
+    assert len(index.get_all()) == len(titles) - 1
+
+    with pytest.raises(ValueError):
+        konl_search.index("v2", StorageFormat.V1)
+
+    index.close()
+
+
+def test_convert_legacy_postings(index):
+    inverted_index = index._inverted_index
+    trie = inverted_index._trie
+    tokens = sorted(index.get_tokens(5))
+    expected = index.search(tokens, TokenSearchMode.OR)
+    phrase = index.search(["마법", "소녀"], TokenSearchMode.PHRASE)
+    trie_size = len(trie._token_dict)
+
+    # the first documents go back to the set postings written before the block format
+    for document_id in range(1, 31):
+        document_tokens = index.get_tokens(document_id)
+        inverted_index.delete(document_id, document_tokens)
+
+        for token in document_tokens:
+            inverted_index._cf[f'{token}:set:{document_id}'] = "1"
+            inverted_index._cf[f'{token}:__len__:set'] = 1
+
+    inverted_index._cf["유령:set:999"] = "1"
+
+    assert 5 not in index.search(tokens, TokenSearchMode.OR)
+    assert convert_legacy_postings(index, 7) == 30
+    assert index.search(tokens, TokenSearchMode.OR) == expected
+    assert index.search(["마법", "소녀"], TokenSearchMode.PHRASE) == phrase
+    assert index.count(tokens, TokenSearchMode.OR) == len(expected) and len(trie._token_dict) == trie_size
+    assert not any(type(key) == str and ":set" in key for key in inverted_index._cf.keys())
+
+
+def test_legacy_postings_on_open(konl_search):
+    index = konl_search.index("title")
+
+    for title in titles:
+        index.index(title)
+
+    expected = index.search(["마법"], TokenSearchMode.OR)
+    inverted_index = index._inverted_index
+
+    for document_id in expected:
+        document_tokens = index.get_tokens(document_id)
+        inverted_index.delete(document_id, document_tokens)
+
+        for token in document_tokens:
+            inverted_index._cf[f'{token}:set:{document_id}'] = "1"
+
+    index._cf.delete("storage_format")
+    index.close()
+
+    index = konl_search.index("title")
+
+    assert index.search(["마법"], TokenSearchMode.OR) == expected
+    assert index.get_storage_format() == StorageFormat.V1 and "storage_format" in index._cf
+    assert not any(isinstance(key, str) and ":set:" in key for key in index._inverted_index._cf.keys())
+
+    index.close()
+
+
+def test_migrate_index(index):
+    assert migrate_index(index, StorageFormat.V1) == 0
+    assert "title_documents" not in rocksdict.Rdict.list_cf(index._db.path())
+
+    documents = index.get_all()
+    lengths = [index.get_length(document.result.id) for document in documents]
+    tokens = index.get_tokens(12)
+
+    index.delete(10)
+
+    expected = index.search(["마법소녀", "사랑"], TokenSearchMode.OR)
+
+    assert migrate_index(index, StorageFormat.V2, 7) == len(titles) - 1
+    assert index.get_storage_format() == StorageFormat.V2
+    assert not any(type(key) == str and key.startswith("title:document") for key in index._cf.keys())
+    assert len(list(index._document_cf.keys())) == len(titles) - 1
+    assert index.get_all() == [document for document in documents if document.result.id != 10]
+    assert [index.get_length(document.result.id) for document in documents] == lengths[:9] + [0] + lengths[10:]
+    assert index.get_tokens(12) == tokens
+    assert index.search(["마법소녀", "사랑"], TokenSearchMode.OR) == expected
+    assert not any(type(key) == str and key.startswith("사랑:") for key in index._inverted_index._cf.keys())
+
+    index.delete(11)
+
+    assert index.get(11).status_code == GetStatusCode.FAILURE
+    assert migrate_index(index, StorageFormat.V2) == 0
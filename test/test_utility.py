@@ -7,3 +7,18 @@ def test_is_sorted():
 
     l2 = [1, 2, 4, 3]
     assert not utility.is_sorted(l2)
+
+
+def test_batched():
+    assert list(utility.batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(utility.batched([], 2)) == []
+
+
+def test_min_span():
+    assert utility.min_span([[1, 10], [4, 12], [13]]) == 3
+    assert utility.min_span([[5]]) == 0
+
+
+def test_sorted_merges():
+    assert list(utility.unique_sorted([1, 1, 2, 3, 3])) == [1, 2, 3]
+    assert list(utility.intersect_sorted(iter([1, 3, 5, 7]), iter([3, 4, 5, 8]))) == [3, 5]